@@ -23,7 +23,7 @@ class NetworkAdapter {
     private val TAG = NetworkAdapter::class.qualifiedName
 
     private val frameHeaderSize = 6 + 4 + 4
-    private var inputStream: BufferedReader? = null
+    private var inputStream: DataInputStream? = null
     private var outputStream: DataOutputStream? = null
     private var socket: Socket? = null
     private var processorConfig: ProcessorConfig? = null
@@ -31,6 +31,7 @@ class NetworkAdapter {
         context = SerializersModule {
             polymorphic<Response> {
                 ConfirmationResponse::class with ConfirmationResponse.serializer()
+                DroppedResponse::class with DroppedResponse.serializer()
                 ModelReadyResponse::class with ModelReadyResponse.serializer()
                 PingResponse::class with PingResponse.serializer()
                 ResultResponse::class with ResultResponse.serializer()
@@ -39,6 +40,10 @@ class NetworkAdapter {
     )
     private val rateLimiter = RateLimiter()
 
+    // (name, description) of each class, for labelling binary results
+    private var classLabels: List<Pair<String, String>>? = null
+    private var resultFormat = "json"
+
     lateinit var uploadStats: UploadStats
     val timeUntilWriteAvailable get() = uploadStats.timeUntilAvailable
     var uploadLimitRate
@@ -63,8 +68,12 @@ class NetworkAdapter {
         // Ensure write+flush turns into a packet by disabling Nagle
         socket!!.tcpNoDelay = true
 
-        inputStream = BufferedReader(InputStreamReader(socket!!.inputStream))
+        inputStream = DataInputStream(BufferedInputStream(socket!!.inputStream))
         outputStream = DataOutputStream(BufferedOutputStream(socket!!.outputStream))
+
+        // Compact binary results are labelled here, if labels are available
+        classLabels = loadClassLabels()
+        resultFormat = if (classLabels != null) "binary" else "json"
     }
 
     private fun tryConnect(hostnames: List<String>, port: Int) {
@@ -90,17 +99,61 @@ class NetworkAdapter {
     fun readResponse(): Response? {
         while (true) {
             val response = readResponseInner() ?: return null
-            if (response is ConfirmationResponse)
-                handleConfirmation(response)
-            else
-                return response
+            when (response) {
+                is ConfirmationResponse -> handleConfirmation(response)
+                is DroppedResponse -> {
+                    handleDropped(response)
+                    return response
+                }
+                else -> return response
+            }
         }
     }
 
     private fun readResponseInner(): Response? {
-        val msg = inputStream!!.readLine() ?: return null
-        Log.i(TAG, "Receive: $msg")
-        return jsonSerializer.parse(PolymorphicSerializer(Response::class), msg) as Response
+        val type = inputStream!!.read()
+        val response = when (type) {
+            -1 -> return null
+            BINARY_CONFIRMATION -> with(inputStream!!) {
+                ConfirmationResponse(readInt(), readInt())
+            }
+            BINARY_RESULT -> readBinaryResult()
+            BINARY_DROPPED -> with(inputStream!!) {
+                DroppedResponse(readInt(), readInt())
+            }
+            else -> {
+                val msg = readLine(type) ?: return null
+                jsonSerializer.parse(PolymorphicSerializer(Response::class), msg) as Response
+            }
+        }
+        Log.i(TAG, "Receive: $response")
+        return response
+    }
+
+    private fun readBinaryResult(): ResultResponse = with(inputStream!!) {
+        val frameNumber = readInt()
+        val inferenceTime = readInt().toLong() and 0xffffffffL
+        val k = readUnsignedByte()
+        val indices = List(k) { readUnsignedShort() }
+        val scores = List(k) { readFloat() }
+        val predictions = indices.zip(scores) { i, score ->
+            val (name, description) = classLabels?.getOrNull(i) ?: Pair("$i", "$i")
+            Prediction(name, description, score)
+        }
+        ResultResponse(frameNumber, inferenceTime, predictions)
+    }
+
+    /** Read rest of a newline-terminated UTF-8 line, given its first byte. */
+    private fun readLine(first: Int): String? {
+        val bytes = ByteArrayOutputStream()
+        var b = first
+        while (b != '\n'.toInt()) {
+            if (b == -1)
+                return null
+            bytes.write(b)
+            b = inputStream!!.read()
+        }
+        return bytes.toString("UTF-8")
     }
 
     private fun handleConfirmation(response: ConfirmationResponse) {
@@ -108,6 +161,11 @@ class NetworkAdapter {
         Log.i(TAG, "Confirmation: $response\nRemaining bytes: ${uploadStats.remainingBytes}")
     }
 
+    private fun handleDropped(response: DroppedResponse) {
+        // Bytes of dropped frames were already confirmed on receipt
+        Log.i(TAG, "Dropped: $response")
+    }
+
     private fun writeData(frameNumber: Int, data: ByteArray) {
         uploadStats.sendBytes(frameNumber, frameHeaderSize + data.size)
         with(outputStream!!) {
@@ -146,7 +204,10 @@ class NetworkAdapter {
 
     @UnstableDefault
     fun writeProcessorConfig(processorConfig: ProcessorConfig) {
-        val jsonString = Json.stringify(ProcessorConfig.serializer(), processorConfig)
+        val jsonString = Json.stringify(
+            ProcessorConfig.serializer(),
+            processorConfig.copy(resultFormat = resultFormat)
+        )
         // uploadStats.sendBytes(frameNumber, 6 + jsonString.length)
         writeJson(jsonString)
         switchModel()
@@ -174,6 +235,22 @@ class NetworkAdapter {
     }
 }
 
+// Binary messages start with a type byte, which never collides with the
+// opening brace of JSON messages. All fields are big-endian.
+private const val BINARY_CONFIRMATION = 1
+private const val BINARY_RESULT = 2
+private const val BINARY_DROPPED = 3
+
+/** Labels of ImageNet classes, if imagenet_class_index.json is provided. */
+@UnstableDefault
+private fun loadClassLabels(): List<Pair<String, String>>? {
+    val classIndex = loadJsonFromDefaultFolder("imagenet_class_index.json") ?: return null
+    return List(classIndex.size) { i ->
+        val (name, description) = classIndex[i.toString()]!!.jsonArray.map { it.content }
+        Pair(name, description)
+    }
+}
+
 class RateLimiter {
     var rate: Long? = null
     private val timeStep = 100
@@ -276,6 +353,13 @@ data class ConfirmationResponse(
     val numBytes: Int
 ) : Response()
 
+@Serializable
+@SerialName("dropped")
+data class DroppedResponse(
+    val frameNumber: Int,
+    val numBytes: Int
+) : Response()
+
 @Serializable
 @SerialName("ready")
 data class ModelReadyResponse(
@@ -331,5 +415,6 @@ data class PostencoderConfig(
 @Serializable
 data class ProcessorConfig(
     @SerialName("model_config") val modelConfig: ModelConfig,
-    @SerialName("postencoder_config") val postencoderConfig: PostencoderConfig
+    @SerialName("postencoder_config") val postencoderConfig: PostencoderConfig,
+    @SerialName("result_format") val resultFormat: String = "json"
 )
@@ -42,6 +42,12 @@ class PostencoderManager {
                 "server" -> JpegRgbPostencoder(inLayout!!)
                 else -> JpegPostencoder(inLayout!!)
             }
+            // Android cannot encode single-channel JPEGs, but the server decodes
+            // only the luma of the neutral-chroma JPEGs of JpegPostencoder
+            "jpeg_gray" -> when (processorConfig.modelConfig.layer) {
+                "client", "server" -> throw IllegalArgumentException()
+                else -> JpegPostencoder(inLayout!!)
+            }
             "h264" -> throw NotImplementedError()
             else -> throw NotImplementedError()
         }
@@ -86,7 +86,7 @@ class PostencoderUiController(
             "client" -> listOf("None")
             "server" -> listOf("jpeg", "None")
             else -> when (it.encoder) {
-                "UniformQuantizationU8Encoder" -> listOf("jpeg", "None")
+                "UniformQuantizationU8Encoder" -> listOf("jpeg", "jpeg_gray", "None")
                 else -> listOf("None")
             }
         }
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+"""Micro-benchmarks of per-frame tensor codecs and tiling.
+
+Sweeps the tensor shapes of the split points listed in models.json,
+dtypes and JPEG qualities, and reports time per frame, peak memory
+allocated per frame and bytes produced:
+
+    python benchmark_codecs.py --output before.json
+    python benchmark_codecs.py --compare before.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Tuple
+
+import numpy as np
+from tensorflow import keras
+
+from src.lib.layouts import TensorLayout
+from src.lib.postencode import JpegGrayPostencoder, JpegPostencoder
+from src.lib.predecode import (
+    JpegGrayPredecoder,
+    JpegPredecoder,
+    RgbPredecoder,
+    TensorPredecoder,
+)
+from src.lib.tile import detile, determine_tile_layout, tile
+from src.modelconfig import read_model_configs
+
+# Shapes (hwc) of split points of 224x224 models, used for models that
+# have not been generated
+KNOWN_SHAPES = {
+    "resnet": [(56, 56, 64), (28, 28, 128), (14, 14, 256)],
+    "vgg": [(14, 14, 512), (7, 7, 512)],
+}
+RGB_SHAPE = (224, 224, 3)
+
+QUALITIES = [10, 50, 90]
+
+# Minimum time (s) of each timed repeat
+MIN_REPEAT_TIME = 0.05
+
+
+def split_shapes() -> List[Tuple[int, int, int]]:
+    """Shapes of tensors at split points listed in models.json."""
+    shapes = set()
+    for model_name, model_configs in read_model_configs().items():
+        layers = {x.layer for x in model_configs} - {"client", "server"}
+        path = f"models/{model_name}/{model_name}-full.h5"
+        if not os.path.isfile(path):
+            family = model_name.rstrip("0123456789")
+            shapes.update(KNOWN_SHAPES.get(family, []))
+            continue
+        model = keras.models.load_model(path, compile=False)
+        for layer in layers:
+            shapes.add(tuple(model.get_layer(layer).output_shape[1:]))
+    return sorted(shapes, key=lambda x: np.prod(x))
+
+
+def measure(fn: Callable[[], Any], repeats: int) -> Dict[str, float]:
+    """Time (ns) per call, peak memory (B) allocated by a call, and size
+    (B) of its output."""
+    out = fn()
+    number = 1
+    while True:
+        t = _time(fn, number)
+        if t >= MIN_REPEAT_TIME:
+            break
+        number *= 2
+    times = [t] + [_time(fn, number) for _ in range(repeats - 1)]
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "nsPerFrame": min(times) / number * 1e9,
+        "peakAllocBytes": peak,
+        "outputBytes": len(out) if isinstance(out, bytes) else out.nbytes,
+    }
+
+
+def _time(fn: Callable[[], Any], number: int) -> float:
+    t = time.perf_counter()
+    for _ in range(number):
+        fn()
+    return time.perf_counter() - t
+
+
+def cases(rng: np.random.Generator):
+    """Yields (name, params, fn) of each benchmark case."""
+    rgb = rng.integers(0, 256, RGB_SHAPE, dtype=np.uint8)
+    predecoder = RgbPredecoder(RGB_SHAPE, np.float32)
+    buf = rgb.tobytes()
+    yield "RgbPredecoder", {"shape": RGB_SHAPE}, lambda: predecoder.run(buf)
+
+    for shape in split_shapes():
+        h, w, c = shape
+        for dtype in (np.float32, np.uint8):
+            params = {"shape": shape, "dtype": np.dtype(dtype).name}
+            arr = _feature_map(rng, shape, dtype)
+            tensor_layout = TensorLayout(dtype, c, h, w, "hwc")
+            tiled_layout = determine_tile_layout(tensor_layout)
+            tiled = tile(arr, tensor_layout, tiled_layout)
+            buf = arr.tobytes()
+            predecoder = TensorPredecoder(shape, dtype)
+
+            yield "tile", params, lambda: tile(
+                arr, tensor_layout, tiled_layout
+            )
+            yield "detile", params, lambda: detile(
+                tiled, tiled_layout, tensor_layout
+            )
+            yield "TensorPredecoder", params, lambda: predecoder.run(buf)
+
+            if dtype != np.uint8:
+                continue
+
+            for quality in QUALITIES:
+                params = {**params, "quality": quality}
+                postencoder = JpegPostencoder(tensor_layout, quality)
+                jpeg = postencoder.run(arr)
+                predecoder = JpegPredecoder(tiled_layout, tensor_layout)
+                yield "JpegPostencoder", params, lambda: postencoder.run(arr)
+                yield "JpegPredecoder", params, lambda: predecoder.run(jpeg)
+
+                postencoder = JpegGrayPostencoder(tensor_layout, quality)
+                jpeg = postencoder.run(arr)
+                predecoder = JpegGrayPredecoder(tiled_layout, tensor_layout)
+                yield "JpegGrayPostencoder", params, lambda: postencoder.run(
+                    arr
+                )
+                yield "JpegGrayPredecoder", params, lambda: predecoder.run(
+                    jpeg
+                )
+
+            # Rate control in steady state, warm-started from the quality
+            # found for the previous frame
+            max_bytes = len(JpegPostencoder(tensor_layout, 50).run(arr))
+            params = {"shape": shape, "dtype": "uint8", "maxBytes": max_bytes}
+            postencoder = JpegPostencoder(tensor_layout, max_bytes=max_bytes)
+            yield "JpegPostencoder", params, lambda: postencoder.run(arr)
+
+
+def _feature_map(
+    rng: np.random.Generator, shape: Tuple[int, int, int], dtype: type
+) -> np.ndarray:
+    """Smooth random tensor, which compresses somewhat like a real
+    feature map."""
+    h, w, c = shape
+    x = rng.random((-(-h // 4), -(-w // 4), c))
+    x = x.repeat(4, axis=0).repeat(4, axis=1)[:h, :w]
+    if dtype == np.uint8:
+        return (x * 255.99).astype(np.uint8)
+    return x.astype(dtype)
+
+
+def _key(result: Dict[str, Any]) -> str:
+    return json.dumps(
+        {k: v for k, v in result.items() if k in ("name", "params")},
+        sort_keys=True,
+    )
+
+
+def print_results(results: List[Dict[str, Any]], baseline: Dict[str, Any]):
+    print(
+        f"{'case':<20} {'params':<36} {'ns/frame':>12} {'peak B':>10} "
+        f"{'out B':>10} {'vs base':>8}"
+    )
+    for r in results:
+        params = " ".join(f"{v}" for v in r["params"].values())
+        ratio = ""
+        base = baseline.get(_key(r))
+        if base is not None:
+            ratio = f"{r['nsPerFrame'] / base['nsPerFrame']:.2f}x"
+        print(
+            f"{r['name']:<20} {params:<36} {r['nsPerFrame']:>12.0f} "
+            f"{r['peakAllocBytes']:>10} {r['outputBytes']:>10} {ratio:>8}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--repeats", type=int, default=5, help="timed repeats per case"
+    )
+    parser.add_argument(
+        "--filter", default="", help="only run cases whose name contains this"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results as JSON to file")
+    parser.add_argument(
+        "--compare", help="JSON results of earlier run, to compare against"
+    )
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = {_key(x): x for x in json.load(f)["results"]}
+
+    rng = np.random.default_rng(args.seed)
+    results = []
+    for name, params, fn in cases(rng):
+        if args.filter not in name:
+            continue
+        results.append(
+            {"name": name, "params": params, **measure(fn, args.repeats)}
+        )
+    print_results(results, baseline)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "numpy": np.__version__,
+                    "machine": platform.machine(),
+                    "results": results,
+                },
+                f,
+                indent=4,
+            )
+
+
+if __name__ == "__main__":
+    main()
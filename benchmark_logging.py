@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+"""Measures how per-frame logging stalls the event loop.
+
+A coroutine emits the per-frame events of a client's read/write loop,
+while a ticker coroutine measures how late the event loop wakes it up.
+Log output goes to stderr, optionally slowed down to mimic a terminal
+that cannot keep up (e.g. over SSH):
+
+    python benchmark_logging.py --write-delay 0.2 2>/dev/null
+"""
+
+import argparse
+import asyncio
+import logging
+import sys
+import time
+from typing import Dict, List, TextIO
+
+import numpy as np
+
+from src.server import log
+from src.server.log import LogConfig, frame_logger
+
+TICK_INTERVAL = 0.001
+
+
+class SlowStream:
+    """Stream whose writes block for a fixed time."""
+
+    def __init__(self, stream: TextIO, delay: float):
+        self.stream = stream
+        self.delay = delay
+
+    def write(self, s: str):
+        time.sleep(self.delay)
+        return self.stream.write(s)
+
+    def flush(self):
+        self.stream.flush()
+
+
+async def emit_print(num_frames: int, stream: TextIO):
+    """Per-frame prints, as produce and consume used to do."""
+    for i in range(num_frames):
+        print("Read begin", file=stream)
+        print("Read end", file=stream)
+        print(f"Produce: {i} 000102030405...fdfeff", file=stream)
+        await asyncio.sleep(0)
+        print(f"Consume {i}: 12 B", file=stream)
+        print("Write begin", file=stream)
+        print("Drain...", file=stream)
+        print("Write end", file=stream)
+        await asyncio.sleep(0)
+
+
+async def emit_log(num_frames: int, stream: TextIO):
+    """Per-frame log events, as produce and consume now do."""
+    for i in range(num_frames):
+        if frame_logger.isEnabledFor(logging.DEBUG):
+            frame_logger.debug("Produce: %d %s", i, "000102030405...fdfeff")
+        await asyncio.sleep(0)
+        frame_logger.debug("Consume %d: %d B", i, 12)
+        await asyncio.sleep(0)
+
+
+async def tick(lags: List[float], done: asyncio.Event):
+    while not done.is_set():
+        t = time.monotonic()
+        await asyncio.sleep(TICK_INTERVAL)
+        lags.append(time.monotonic() - t - TICK_INTERVAL)
+
+
+async def run(emit, num_frames: int, stream: TextIO) -> Dict[str, float]:
+    lags = []
+    done = asyncio.Event()
+    ticker = asyncio.create_task(tick(lags, done))
+    t = time.monotonic()
+    await emit(num_frames, stream)
+    elapsed = time.monotonic() - t
+    done.set()
+    await ticker
+    p50, p99 = np.percentile(lags, [50, 99]) * 1000
+    return {
+        "fps": num_frames / elapsed,
+        "lag_p50": p50,
+        "lag_p99": p99,
+        "lag_max": max(lags) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--frames", type=int, default=2000)
+    parser.add_argument(
+        "--write-delay",
+        type=float,
+        default=0.0,
+        help="time (ms) each write to stderr blocks for",
+    )
+    args = parser.parse_args()
+
+    stream = sys.stderr
+    if args.write_delay > 0:
+        stream = SlowStream(stream, args.write_delay / 1000)
+
+    modes = [
+        ("print", emit_print, None),
+        ("log (info)", emit_log, LogConfig(logging.INFO)),
+        ("log (debug, 1/100)", emit_log, LogConfig(logging.DEBUG, 100)),
+        ("log (debug, all)", emit_log, LogConfig(logging.DEBUG, 1)),
+    ]
+
+    print(
+        f"{'mode':<20} {'fps':>10} {'p50 lag':>10} {'p99 lag':>10} "
+        f"{'max lag':>10}"
+    )
+    for name, emit, log_config in modes:
+        listener = None
+        if log_config is not None:
+            listener = log.setup_logging(log_config, stream)
+        r = asyncio.run(run(emit, args.frames, stream))
+        if listener is not None:
+            listener.stop()
+        print(
+            f"{name:<20} {r['fps']:>10.0f} {r['lag_p50']:>8.2f}ms "
+            f"{r['lag_p99']:>8.2f}ms {r['lag_max']:>8.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
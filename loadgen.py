@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+
+"""Load generator for the inference server.
+
+Simulates clients that stream frames at a fixed rate, using the same
+protocol as the Android app, and reports throughput and latency.
+
+A tiny stand-in model can be created, so that runs do not depend on
+downloaded weights:
+
+    python loadgen.py --make-model
+    python server.py &
+    python loadgen.py --clients 4 --fps 30 --duration 10
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+import numpy as np
+from tensorflow import keras
+
+from src.lib.layouts import TensorLayout
+from src.lib.postencode import JpegGrayPostencoder, JpegPostencoder
+from src.modelconfig import ModelConfig
+from src.server.comm import read_message
+from src.utils import split_model_by_config
+
+HOST = "127.0.0.1"
+PORT = 5678
+
+# Stand-in model, with the shape of the tensor sent for each layer
+STAND_IN_MODEL = "tiny"
+STAND_IN_SHAPES = {"server": (32, 32, 3), "conv2": (16, 16, 16)}
+STAND_IN_CONFIGS = [
+    ModelConfig(STAND_IN_MODEL, "server"),
+    ModelConfig(STAND_IN_MODEL, "conv2"),
+    ModelConfig(
+        STAND_IN_MODEL,
+        "conv2",
+        "UniformQuantizationU8Encoder",
+        "UniformQuantizationU8Decoder",
+        {"clip_range": [0.0, 4.0]},
+        {"clip_range": [0.0, 4.0]},
+    ),
+]
+
+POSTENCODERS = {"jpeg": JpegPostencoder, "jpeg_gray": JpegGrayPostencoder}
+
+# Number of distinct frames each client cycles through
+NUM_FRAMES = 8
+PING_INTERVAL = 1.0
+
+
+def make_stand_in_model():
+    """Save tiny classifier, along with server models of its splits."""
+    prefix = f"models/{STAND_IN_MODEL}/{STAND_IN_MODEL}"
+    os.makedirs(os.path.dirname(prefix), exist_ok=True)
+    x = inputs = keras.Input(STAND_IN_SHAPES["server"])
+    x = keras.layers.Conv2D(
+        8, 3, strides=2, padding="same", activation="relu", name="conv1"
+    )(x)
+    x = keras.layers.Conv2D(
+        16, 3, padding="same", activation="relu", name="conv2"
+    )(x)
+    x = keras.layers.GlobalAveragePooling2D(name="pool")(x)
+    x = keras.layers.Dense(1000, activation="softmax", name="predictions")(x)
+    model = keras.Model(inputs=inputs, outputs=x)
+    model.save(f"{prefix}-full.h5")
+    for model_config in STAND_IN_CONFIGS:
+        if model_config.layer == "server":
+            continue
+        # Force usage of tf.keras.Model which has Nodes linked correctly
+        model = keras.models.load_model(f"{prefix}-full.h5")
+        _, model_server, _ = split_model_by_config(model, model_config)
+        model_server.save(f"models/{model_config.to_path()}-server.h5")
+        print(f"Saved {model_config.to_path()}")
+
+
+def make_frames(
+    model_config: ModelConfig,
+    shape: Tuple[int, int, int],
+    postencoder: str,
+    quality: int,
+    max_bytes: int,
+    rng: np.random.Generator,
+) -> List[bytes]:
+    """Encoded frames, as a client would send them."""
+    h, w, c = shape
+    is_rgb = model_config.layer == "server"
+    is_quantized = model_config.encoder != "None"
+    dtype = np.uint8 if is_rgb or is_quantized else np.float32
+    if postencoder in POSTENCODERS and not is_quantized:
+        raise ValueError("JPEG postencoder requires a quantizing encoder")
+    frames = []
+    for _ in range(NUM_FRAMES):
+        # Blocky noise compresses somewhat like real feature maps
+        x = rng.random((-(-h // 4), -(-w // 4), c))
+        x = x.repeat(4, axis=0).repeat(4, axis=1)[:h, :w]
+        if dtype == np.uint8:
+            x = (x * 255.99).astype(np.uint8)
+        else:
+            x = (x * 4).astype(np.float32)
+        if postencoder in POSTENCODERS:
+            tensor_layout = TensorLayout(dtype, c, h, w, "hwc")
+            postencoder_cls = POSTENCODERS[postencoder]
+            frames.append(
+                postencoder_cls(tensor_layout, quality, max_bytes).run(x)
+            )
+        else:
+            frames.append(x.tobytes())
+    return frames
+
+
+@dataclass
+class ClientStats:
+    # Time at which each frame began to be sent
+    sent: Dict[int, float] = field(default_factory=dict)
+    latencies: List[float] = field(default_factory=list)
+    pings: List[float] = field(default_factory=list)
+    num_dropped: int = 0
+
+
+async def run_client(
+    args: argparse.Namespace,
+    processor_config: dict,
+    frames: List[bytes],
+    start_time: float,
+) -> ClientStats:
+    stats = ClientStats()
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    writer.write(b"json\n" + json.dumps(processor_config).encode() + b"\n")
+    while (await read_message(reader))["type"] != "ready":
+        pass
+
+    pings: Dict[int, float] = {}
+    num_frames = int(args.duration * args.fps)
+    warmup_frames = int(args.warmup * args.fps)
+    received = asyncio.Event()
+    remaining = num_frames
+
+    async def receive():
+        nonlocal remaining
+        while True:
+            msg = await read_message(reader)
+            if msg is None:
+                break
+            t = time.monotonic()
+            if msg["type"] == "ping":
+                if msg["id"] in pings:
+                    stats.pings.append(t - pings.pop(msg["id"]))
+                continue
+            if msg["type"] not in ("result", "dropped"):
+                continue
+            i = msg["frameNumber"]
+            sent = stats.sent.pop(i, None)
+            if sent is None:
+                pass
+            elif msg["type"] == "dropped":
+                stats.num_dropped += 1
+            else:
+                stats.latencies.append(t - sent)
+            remaining -= 1
+            if remaining == 0:
+                received.set()
+
+    task = asyncio.create_task(receive())
+    next_ping = start_time
+    for i in range(num_frames):
+        delay = start_time + i / args.fps - time.monotonic()
+        await asyncio.sleep(max(0, delay))
+        t = time.monotonic()
+        if t >= next_ping:
+            pings[i] = t
+            writer.write(b"ping\n" + i.to_bytes(4, "big"))
+            next_ping += PING_INTERVAL
+        data = frames[i % len(frames)]
+        header = i.to_bytes(4, "big") + len(data).to_bytes(4, "big")
+        writer.write(b"frame\n" + header + data)
+        if i >= warmup_frames:
+            stats.sent[i] = t
+        await writer.drain()
+
+    try:
+        await asyncio.wait_for(received.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        pass
+    task.cancel()
+    writer.close()
+    return stats
+
+
+async def run(args: argparse.Namespace) -> dict:
+    model_config = ModelConfig.from_json_dict(json.loads(args.model_config))
+    shape = args.shape or STAND_IN_SHAPES[model_config.layer]
+    rng = np.random.default_rng(args.seed)
+    frames = make_frames(
+        model_config,
+        shape,
+        args.postencoder,
+        args.quality,
+        args.max_bytes,
+        rng,
+    )
+    processor_config = {
+        "model_config": model_config.to_json_object(),
+        "postencoder_config": {
+            "type": args.postencoder,
+            "quality": args.quality,
+        },
+        "result_format": args.result_format,
+    }
+    # Give clients time to connect and receive their model
+    start_time = time.monotonic() + args.connect_time
+    clients = await asyncio.gather(
+        *(
+            run_client(args, processor_config, frames, start_time)
+            for _ in range(args.clients)
+        )
+    )
+    return summarize(args, clients, np.mean([len(x) for x in frames]))
+
+
+def summarize(
+    args: argparse.Namespace,
+    clients: List[ClientStats],
+    bytes_per_frame: float,
+) -> dict:
+    """Statistics of frames sent after warmup."""
+    latencies = np.concatenate([x.latencies for x in clients] + [[]])
+    pings = np.concatenate([x.pings for x in clients] + [[]])
+    num_frames = int(args.duration * args.fps) - int(args.warmup * args.fps)
+    duration = num_frames / args.fps
+    return {
+        "clients": args.clients,
+        "fps": args.fps,
+        "bytesPerFrame": bytes_per_frame,
+        "sent": args.clients * num_frames,
+        "results": len(latencies),
+        "dropped": sum(x.num_dropped for x in clients),
+        # Neither result nor dropped message received before timeout
+        "lost": sum(len(x.sent) for x in clients),
+        "throughput": len(latencies) / duration,
+        "latency": _percentiles(latencies),
+        "ping": _percentiles(pings),
+    }
+
+
+def _percentiles(x: np.ndarray) -> Dict[str, float]:
+    if len(x) == 0:
+        return {}
+    p50, p90, p99, p100 = np.percentile(x, [50, 90, 99, 100]) * 1000
+    return {"p50": p50, "p90": p90, "p99": p99, "max": p100}
+
+
+def print_summary(summary: dict):
+    print(
+        f"{summary['clients']} clients at {summary['fps']} fps, "
+        f"{summary['bytesPerFrame']:.0f} B/frame"
+    )
+    print(
+        f"sent {summary['sent']}, results {summary['results']}, "
+        f"dropped {summary['dropped']}, lost {summary['lost']}"
+    )
+    print(f"throughput: {summary['throughput']:.1f} frames/s")
+    for name in ("latency", "ping"):
+        ms = " ".join(f"{k} {v:.1f}" for k, v in summary[name].items())
+        print(f"{name} (ms): {ms}")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Load generator.")
+    parser.add_argument(
+        "--make-model",
+        action="store_true",
+        help=f"save stand-in model '{STAND_IN_MODEL}' to models/, and exit",
+    )
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument(
+        "--clients", type=int, default=1, help="number of clients"
+    )
+    parser.add_argument(
+        "--fps", type=float, default=30, help="frame rate of each client"
+    )
+    parser.add_argument(
+        "--duration", type=float, default=10, help="time (s) to send for"
+    )
+    parser.add_argument(
+        "--warmup",
+        type=float,
+        default=1,
+        help="time (s) at start of run to exclude from statistics",
+    )
+    parser.add_argument(
+        "--connect-time",
+        type=float,
+        default=2,
+        help="time (s) allowed for clients to connect and load models",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=5,
+        help="time (s) to wait for outstanding results after sending",
+    )
+    parser.add_argument(
+        "--model-config",
+        default=json.dumps(STAND_IN_CONFIGS[1].to_json_object()),
+        help="model config requested by each client, as JSON",
+    )
+    parser.add_argument(
+        "--shape",
+        type=int,
+        nargs=3,
+        metavar=("H", "W", "C"),
+        help="shape of tensors sent; known for the stand-in model",
+    )
+    parser.add_argument(
+        "--postencoder", choices=["None", *POSTENCODERS], default="None"
+    )
+    parser.add_argument("--quality", type=int, default=50)
+    parser.add_argument(
+        "--max-bytes",
+        type=int,
+        help="encode each JPEG frame at the highest quality that fits "
+        "within this many bytes, instead of at --quality",
+    )
+    parser.add_argument(
+        "--result-format",
+        choices=["json", "binary"],
+        default="json",
+        help="format of results, confirmations and dropped messages",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output", help="also write summary as JSON to this file"
+    )
+    args = parser.parse_args()
+    num_frames = int(args.duration * args.fps) - int(args.warmup * args.fps)
+    if not args.make_model and num_frames <= 0:
+        parser.error("--duration must leave frames to send after --warmup")
+    return args
+
+
+def main():
+    args = parse_args()
+    if args.make_model:
+        make_stand_in_model()
+        return
+    summary = asyncio.run(run(args))
+    print_summary(summary)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -19,9 +19,12 @@ ipcRenderer.on("update", (_event, data: string) => {
     data.slice(0, 60) + (data.length > 60 ? "..." : "");
   frameNumberText.textContent = d["frameNumber"];
   inferenceTimeText.textContent = d["inferenceTime"];
-  dataPreviewText.textContent =
-    d["data"].slice(0, 60) + (d["data"].length > 60 ? "..." : "");
-  tensorViewImage.src = d["data"] != "" ? d["data"] : blackPng
+  // Preview is omitted if unchanged since the previous update
+  if ("data" in d) {
+    dataPreviewText.textContent =
+      d["data"].slice(0, 60) + (d["data"].length > 60 ? "..." : "");
+    tensorViewImage.src = d["data"] != "" ? d["data"] : blackPng;
+  }
   updateTable(predictionsTable, predictionsFormatter(d["predictions"]));
 });
 
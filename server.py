@@ -2,37 +2,40 @@
 
 from __future__ import annotations
 
+import argparse
 import asyncio
-import json
+import logging
 import time
-import traceback
 from asyncio import StreamReader, StreamWriter
-from collections import defaultdict
-from dataclasses import dataclass
 from itertools import count
-from typing import ByteString, Dict
+from typing import ByteString, Callable, Dict, List, Union
 
-import numpy as np
-
-from src.lib.layouts import TensorLayout
-from src.lib.predecode import Predecoder
-from src.modelconfig import ModelConfig, ProcessorConfig
-from src.server import monitor_client
+from src.modelconfig import (
+    ModelConfig,
+    ProcessorConfig,
+    read_model_configs,
+)
+from src.server import log, metrics, monitor_client
 from src.server.comm import (
+    binary_confirmation,
     json_confirmation,
     json_ping,
-    json_ready,
-    json_result,
 )
-from src.server.model_manager import ModelManager
-from src.server.monitor_client import MonitorStats, image_preview
+from src.server.log import LogConfig, frame_logger
+from src.server.metrics import ServerMetrics
+from src.server.monitor_client import MonitorStats
 from src.server.reader import read_item
-from src.server.work_distributor import SmartProcessor, WorkDistributor
-from src.utils import get_predecoder
+from src.server.stats import Timestamps
+from src.server.stream import BufferPool, start_server
+from src.server.work_distributor import WorkDistributor
+from src.server.worker_pool import WorkerPool
 
 IP = "0.0.0.0"
 PORT = 5678
 PORT2 = 5680
+PORT3 = 5681
+
+logger = logging.getLogger(__name__)
 
 
 def str_preview(s: ByteString, max_len=16):
@@ -41,118 +44,58 @@ def str_preview(s: ByteString, max_len=16):
     return f"{s[:max_len - 6].hex()}...{s[-3:].hex()}"
 
 
-@dataclass
-class State:
-    model_config: ModelConfig = None
-    predecoder: Predecoder = None
-    tensor_layout: TensorLayout = None
-
-
-# TODO document that this happens on a single dedicated thread
-# TODO turn this into a class or something
-def processor(work_distributor: WorkDistributor, monitor_stats: MonitorStats):
-    """Process work items received from work distributor."""
-    model_manager = ModelManager()
-    smart_processor = SmartProcessor(work_distributor)
-    states: Dict[int, State] = defaultdict(State)
-
-    while True:
-        try:
-            guid, item = smart_processor.get()
-            request_type, item = item
-            state = states[guid]
-
-            if request_type == "terminate":
-                work_distributor.put(guid, None)
-            elif request_type == "acquire":
-                model_config = item
-                assert state.model_config is None
-                model_manager.acquire(model_config)
-                state.model_config = model_config
-                # TODO have client provide the tiled_layout
-                state.tensor_layout = model_manager.input_tensor_layout(
-                    model_config
-                )
-            elif request_type == "release":
-                model_config = item
-                assert model_config == state.model_config
-                model_manager.release(model_config)
-                state.model_config = None
-            elif request_type == "init_postencoder":
-                postencoder_config = item
-                state.predecoder = get_predecoder(
-                    postencoder_config, state.model_config, state.tensor_layout
-                )
-            elif request_type == "predict":
-                frame_number, buf = item
-                model_config = state.model_config
-                confirmation = json_confirmation(
-                    frame_number=frame_number, num_bytes=len(buf)
-                )
-                confirmation = f"{confirmation}\n".encode("utf8")
-                work_distributor.put(guid, confirmation)
-                # TODO predecode_time separately from inference_time
-                t0 = time.time()
-                data_tensor = state.predecoder.run(buf)
-                data_tensor = data_tensor[np.newaxis, ...]
-                preds = model_manager.predict(model_config, data_tensor)
-                preds = model_manager.decode_predictions(model_config, preds)
-                t1 = time.time()
-                inference_time = int(1000 * (t1 - t0))
-                result = json_result(
-                    frame_number=frame_number,
-                    inference_time=int(1000 * (t1 - t0)),
-                    predictions=preds,
-                )
-                result = f"{result}\n".encode("utf8")
-                work_distributor.put(guid, result)
-                monitor_stats.add(
-                    frame_number=frame_number,
-                    # data_shape=..., # TODO different shapes for data?
-                    inference_time=inference_time,
-                    predictions=preds,
-                    data=image_preview(data_tensor),
-                )
-            elif request_type == "ready":
-                ready = json_ready(model_config=state.model_config)
-                ready = f"{ready}\n".encode("utf8")
-                work_distributor.put(guid, ready)
-            elif request_type == "ping":
-                id_ = item
-                response = f"{json_ping(id_)}\n".encode("utf8")
-                work_distributor.put(guid, response)
-            else:
-                raise ValueError("Unknown request type")
-        except Exception:
-            traceback.print_exc()
-
-
-async def produce(reader: StreamReader, putter):
-    """Reads from socket, and pushes requests to processor."""
+async def produce(
+    reader: StreamReader,
+    putter,
+    reply: Callable[[Union[str, bytes]], None],
+    server_metrics: ServerMetrics,
+    dump_frames: bool = False,
+):
+    """Reads from socket, and pushes requests to processor.
+
+    Frames are read into a pool of reusable buffers, which the processor
+    returns to the pool once it is done with them.
+
+    Pings and frame confirmations are replied to immediately, so that
+    they measure the network alone, regardless of inference backlog.
+    """
     model_config: ModelConfig = None
+    result_format = "json"
+    buffer_pool = BufferPool()
 
     try:
         while True:
-            print("Read begin")
-            input_type, item = await read_item(reader)
-            print("Read end")
+            input_type, item = await read_item(reader, buffer_pool)
             if input_type == "terminate":
                 break
             # TODO merge with processor()?
             if input_type == "frame":
-                frame_number, buf = item
-                print(f"Produce: {frame_number} {str_preview(buf)}")
-                with open("frame.dat", "wb") as f:
-                    f.write(buf)
+                if frame_logger.isEnabledFor(logging.DEBUG):
+                    frame_logger.debug(
+                        "Produce: %d %s",
+                        item.frame_number,
+                        str_preview(item.data),
+                    )
+                server_metrics.frame_received(len(item.data))
+                confirmation = {
+                    "json": json_confirmation,
+                    "binary": binary_confirmation,
+                }[result_format]
+                reply(confirmation(item.frame_number, len(item.data)))
+                if dump_frames:
+                    with open("frame.dat", "wb") as f:
+                        f.write(item.data)
+                item.timestamps["enqueue"] = time.monotonic()
                 await putter(("predict", item))
             # TODO why are all json input types handled in this way?
             elif input_type == "json":
                 # TODO this is all very confusing... clarify why next_model_config exists and why we need prev_model_loaded
-                print(f"Produce: {item}")
+                logger.debug("Produce: %s", item)
                 processor_config = ProcessorConfig.from_json_dict(item)
                 prev_model_config = model_config
                 model_config = processor_config.model_config
                 postencoder_config = processor_config.postencoder_config
+                result_format = processor_config.result_format
                 prev_valid = prev_model_config is not None
                 changed = prev_valid and prev_model_config != model_config
                 if changed:
@@ -160,66 +103,278 @@ async def produce(reader: StreamReader, putter):
                 if changed or not prev_valid:
                     await putter(("acquire", model_config))
                 await putter(("init_postencoder", postencoder_config))
+                await putter(
+                    ("init_result_format", processor_config.result_format)
+                )
+                await putter(("init_timings", processor_config.timings))
                 await putter(("ready", None))
             elif input_type == "ping":
-                await putter(("ping", item))
+                reply(json_ping(item))
     finally:
         if model_config is not None:
             await putter(("release", model_config))
         await putter(("terminate", None))
 
 
-async def consume(writer: StreamWriter, getter):
-    """Receives items and writes them to socket."""
+async def consume(
+    writer: StreamWriter,
+    getter,
+    server_metrics: ServerMetrics,
+    on_written: Callable[[Timestamps], None] = None,
+):
+    """Receives items and writes them to socket.
+
+    Items are messages, or results paired with their frame's timestamps,
+    which are passed to on_written once the result has been written.
+    """
     try:
         for i in count():
             item = await getter()
             if item is None:
                 break
-            item_d = json.loads(item.decode("utf8"))
-            item_d.pop("predictions", None)
-            print(f"Consume {i}: {item_d}")
-            # print(json.dumps(item_d, indent=4))
-            print("Write begin")
+            timestamps = None
+            if isinstance(item, tuple):
+                item, timestamps = item
+            frame_logger.debug("Consume %d: %d B", i, len(item))
             writer.write(item)
-            print("Drain...")
             await writer.drain()
-            print("Write end")
+            server_metrics.sent(len(item))
+            if timestamps is not None and on_written is not None:
+                timestamps["written"] = time.monotonic()
+                on_written(timestamps)
     finally:
-        print("Closing client...")
         writer.close()
 
 
-def handle_client(work_distributor: WorkDistributor):
+def handle_client(
+    work_distributor: WorkDistributor,
+    monitor_stats: MonitorStats,
+    server_metrics: ServerMetrics,
+    dump_frames: bool,
+    max_rate: float = None,
+):
     async def client_handler(reader: StreamReader, writer: StreamWriter):
-        print("New client...")
         ip, port = writer.get_extra_info("peername")
-        print(f"Connected to {ip}:{port}")
-        putter, getter = work_distributor.register()
-        coros = [produce(reader, putter), consume(writer, getter)]
+        logger.info("Client connected: %s:%d", ip, port)
+        putter, getter = work_distributor.register(max_rate=max_rate)
+
+        def reply(msg: Union[str, bytes]):
+            if isinstance(msg, str):
+                msg = f"{msg}\n".encode("utf8")
+            writer.write(msg)
+            server_metrics.sent(len(msg))
+
+        coros = [
+            produce(reader, putter, reply, server_metrics, dump_frames),
+            consume(
+                writer, getter, server_metrics, monitor_stats.record_stages
+            ),
+        ]
         tasks = map(asyncio.create_task, coros)
         await asyncio.wait(tasks)
+        logger.info("Client disconnected: %s:%d", ip, port)
 
     return client_handler
 
 
-async def main():
-    work_distributor = WorkDistributor()
+async def main(args: argparse.Namespace):
+    log.setup_logging(
+        LogConfig(
+            level=getattr(logging, args.log_level.upper()),
+            sample_every=args.log_sample_every,
+        )
+    )
+    work_distributor = WorkDistributor(maxsize=args.queue_size)
     monitor_stats = MonitorStats()
-    loop = asyncio.get_event_loop()
-    loop.run_in_executor(None, processor, work_distributor, monitor_stats)
-    client_handler = handle_client(work_distributor)
-    server = await asyncio.start_server(client_handler, IP, PORT)
+    server_metrics = ServerMetrics()
+    server_metrics.add_gauge(
+        "ci_queued_requests",
+        "Requests queued for scheduling, across clients",
+        lambda: sum(work_distributor.queue_depths().values()),
+    )
+    server_metrics.add_gauge(
+        "ci_active_clients",
+        "Connected clients",
+        lambda: len(work_distributor.queue_depths()),
+    )
+    worker_pool = WorkerPool(
+        work_distributor,
+        monitor_stats,
+        server_metrics,
+        num_workers=args.workers,
+        kind=args.worker_type,
+        affinity=args.affinity,
+        max_load=args.affinity_max_load,
+        load_cost=args.affinity_load_cost,
+        queue_size=args.worker_queue_size,
+        max_batch_size=args.max_batch_size,
+        max_batch_wait=args.max_batch_wait / 1000,
+        memory_budget=_mb_to_bytes(args.memory_budget),
+        share_weights=args.share_weights,
+        max_pending_frames=args.max_pending_frames,
+        max_frame_age=_ms_to_s(args.max_frame_age),
+    )
+    if args.preload is not None:
+        worker_pool.preload(_preload_configs(args.preload))
+    worker_pool.start()
+    client_handler = handle_client(
+        work_distributor,
+        monitor_stats,
+        server_metrics,
+        args.dump_frames,
+        args.client_max_fps,
+    )
+    server = await start_server(client_handler, IP, PORT)
     monitor_handler = monitor_client.handle_client(monitor_stats)
     monitor_server = await asyncio.start_server(monitor_handler, IP, PORT2)
-    print("Started server")
-    await asyncio.wait(
-        [server.serve_forever(), monitor_server.serve_forever()]
+    metrics_handler = metrics.handle_client(server_metrics)
+    metrics_server = await asyncio.start_server(metrics_handler, IP, PORT3)
+    logger.info("Started server")
+    await asyncio.gather(
+        server.serve_forever(),
+        monitor_server.serve_forever(),
+        metrics_server.serve_forever(),
     )
 
 
-if __name__ == "__main__":
-    asyncio.run(main())
+def _preload_configs(model_names: List[str]) -> Dict[str, List[ModelConfig]]:
+    model_configs = read_model_configs()
+    if "all" in model_names:
+        return model_configs
+    return {k: model_configs[k] for k in model_names}
+
+
+def _mb_to_bytes(mb: float) -> int:
+    return None if mb is None else int(mb * 1000 ** 2)
+
 
+def _ms_to_s(ms: float) -> float:
+    return None if ms is None else ms / 1000
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Inference server.")
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=16,
+        help="maximum number of frames per batched forward pass",
+    )
+    parser.add_argument(
+        "--max-batch-wait",
+        type=float,
+        default=0.0,
+        help="maximum time (ms) to wait for a batch to fill up",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of inference workers",
+    )
+    parser.add_argument(
+        "--worker-type",
+        choices=["thread", "process"],
+        default="thread",
+        help="run inference workers as threads or processes",
+    )
+    parser.add_argument(
+        "--no-affinity",
+        dest="affinity",
+        action="store_false",
+        help="do not route clients to workers already holding their model",
+    )
+    parser.add_argument(
+        "--affinity-max-load",
+        type=int,
+        help="maximum number of clients a worker holding a model serves, "
+        "before further clients of the model spill over to another worker",
+    )
+    parser.add_argument(
+        "--affinity-load-cost",
+        type=int,
+        default=1,
+        help="number of clients a worker holding a model may serve beyond "
+        "the least loaded worker, before further clients of the model "
+        "spill over to it",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=16,
+        help="maximum number of queued requests per client before its "
+        "reads are paused",
+    )
+    parser.add_argument(
+        "--worker-queue-size",
+        type=int,
+        default=2,
+        help="maximum number of requests dispatched to each worker ahead "
+        "of time; small values leave more requests for the fair-share "
+        "scheduler to order",
+    )
+    parser.add_argument(
+        "--client-max-fps",
+        type=float,
+        default=None,
+        help="maximum rate at which each client's frames are scheduled",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=float,
+        default=None,
+        help="memory budget (MB) for resident models, per worker; "
+        "least recently released models are evicted beyond this",
+    )
+    parser.add_argument(
+        "--no-share-weights",
+        dest="share_weights",
+        action="store_false",
+        help="load each split config's server model file separately, "
+        "instead of building it from the shared full model",
+    )
+    parser.add_argument(
+        "--preload",
+        nargs="+",
+        metavar="MODEL",
+        help="models (or 'all') from models.json to load and warm up at "
+        "startup, in the background",
+    )
+    parser.add_argument(
+        "--max-pending-frames",
+        type=int,
+        default=None,
+        help="for real-time streams, drop all but the newest pending "
+        "frames of each client",
+    )
+    parser.add_argument(
+        "--max-frame-age",
+        type=float,
+        default=None,
+        help="for real-time streams, drop frames that have been queued "
+        "for longer than this (ms)",
+    )
+    parser.add_argument(
+        "--dump-frames",
+        action="store_true",
+        help="write each received frame to frame.dat, for debugging",
+    )
+    parser.add_argument(
+        "--log-level",
+        choices=["debug", "info", "warning", "error"],
+        default="info",
+        help="minimum level of logged events; per-frame events are only "
+        "logged at debug level",
+    )
+    parser.add_argument(
+        "--log-sample-every",
+        type=int,
+        default=100,
+        help="log only every nth per-frame event",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
 
-# TODO read, inference, write in parallel, no? (multiprocess.executorpool)
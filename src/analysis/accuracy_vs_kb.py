@@ -12,13 +12,20 @@ from tensorflow import keras
 from src.analysis.dataset import dataset_kb
 from src.analysis.utils import prefix_of, release_models
 from src.lib.layouts import TensorLayout
-from src.lib.postencode import JpegPostencoder, Postencoder
+from src.lib.postencode import (
+    MAX_QUALITY,
+    MIN_QUALITY,
+    JpegPostencoder,
+    Postencoder,
+)
 from src.lib.predecode import JpegPredecoder, Predecoder
 from src.modelconfig import ModelConfig
 from src.utils import split_model_by_config
 
 BATCH_SIZE = 64
 BYTES_PER_KB = 1000
+# Highest KB/frame shown in plots, and so measured
+MAX_KB = 30
 data_dir = "data"
 csv_path = f"{data_dir}/data.csv"
 
@@ -35,12 +42,8 @@ def compute_dataset_accuracies(
 
     for frames, labels in dataset:
         client_tensors = model_client.predict(frames)
-        decoded_tensors = []
-        for client_tensor in client_tensors:
-            encoded_bytes = postencoder.run(client_tensor)
-            decoded_tensor = predecoder.run(encoded_bytes)
-            decoded_tensors.append(decoded_tensor)
-        decoded_tensors = np.array(decoded_tensors)
+        encoded = [postencoder.run(x) for x in client_tensors]
+        decoded_tensors = predecoder.run_many(encoded)
         predictions = model_server.predict(decoded_tensors)
         accuracies.extend(accuracy_func(labels.numpy(), predictions))
 
@@ -128,15 +131,25 @@ def _evaluate_accuracies_shared_kb(
 def _make_quality_lut(
     client_tensors: List[np.ndarray],
 ) -> List[Dict[int, int]]:
+    """For each tensor, the lowest quality at which it encodes to each KB,
+    up to MAX_KB.
+
+    Each KB boundary is found by a quality search, starting from the
+    boundary below it, rather than by encoding every quality.
+    """
     quality_lookup = []
     for client_tensor in client_tensors:
         tensor_layout = TensorLayout.from_tensor(client_tensor, "hwc")
+        search = JpegPostencoder(tensor_layout).quality_search(client_tensor)
+        quality = MIN_QUALITY
         d = {}
-        for quality in range(1, 101):
-            postencoder = JpegPostencoder(tensor_layout, quality)
-            encoded_bytes = postencoder.run(client_tensor)
-            kb = int(len(encoded_bytes) / BYTES_PER_KB)
-            if kb not in d:
+        for kb in range(MAX_KB + 1):
+            # Lowest quality reaching kb is just above highest one below it
+            below = search.max_quality(kb * BYTES_PER_KB - 1, guess=quality)
+            quality = MIN_QUALITY if below is None else below + 1
+            if quality > MAX_QUALITY:
+                break
+            if len(search.encode(quality)) // BYTES_PER_KB == kb:
                 d[kb] = quality
         quality_lookup.append(d)
     return quality_lookup
@@ -165,7 +178,7 @@ def _plot_accuracy_vs_kb(
         labels=["server-only inference", "shared inference"],
         loc="lower right",
     )
-    ax.set(xlim=(0, 30), ylim=(0, 1))
+    ax.set(xlim=(0, MAX_KB), ylim=(0, 1))
 
     # TODO move into set
     ax.set_xlabel("KB/frame")
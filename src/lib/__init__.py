@@ -2,5 +2,6 @@ from src.lib.layers import *
 from src.lib.layouts import *
 from src.lib.postencode import *
 from src.lib.predecode import *
+from src.lib.predictions import *
 from src.lib.split import *
 from src.lib.tile import *
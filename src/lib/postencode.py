@@ -1,11 +1,15 @@
 from io import BytesIO
-from typing import ByteString
+from typing import ByteString, Dict, Optional
 
 import numpy as np
 from PIL import Image
 
 from src.lib.layouts import TensorLayout
-from src.lib.tile import determine_tile_layout, tile
+from src.lib.tile import determine_tile_layout, tile_plan
+
+
+MIN_QUALITY = 1
+MAX_QUALITY = 100
 
 
 class Postencoder:
@@ -14,32 +18,143 @@ class Postencoder:
 
 
 class JpegPostencoder(Postencoder):
+    """Encodes tiled tensor as JPEG.
+
+    If max_bytes is given, each frame is encoded at the highest quality
+    whose JPEG fits within max_bytes (or the lowest quality, if none
+    does). The search starts from the quality of the previous frame,
+    which is usually right or close for a stream of similar frames.
+    """
+
     MBU_SIZE = 16
+    # Channels of encoded image, each holding the tiled tensor
+    CHANNELS = 3
 
     def __init__(
-        self, tensor_layout: TensorLayout, quality: int = None,
+        self,
+        tensor_layout: TensorLayout,
+        quality: int = None,
+        max_bytes: int = None,
     ):
         self.tensor_layout = tensor_layout
         self.quality = quality
+        self.max_bytes = max_bytes
         self.tiled_layout = determine_tile_layout(tensor_layout)
+        self._tile_plan = tile_plan(tensor_layout, self.tiled_layout)
+        # Padded image, reused across frames. Only tiles are
+        # overwritten, so padding and unused tiles remain zero.
+        self._img = self._tile_plan.new_tiled(
+            np.uint8, pad_to=self.MBU_SIZE, channels=self.CHANNELS
+        )
 
     def run(self, arr: np.ndarray) -> ByteString:
-        tiled_tensor = tile(arr, self.tensor_layout, self.tiled_layout)
-        tiled_tensor = np.tile(tiled_tensor[..., np.newaxis], 3)
-        tiled_tensor = _pad(tiled_tensor, JpegPostencoder.MBU_SIZE)
-        client_bytes = _jpeg_encode(tiled_tensor, self.quality)
+        if self.max_bytes is not None:
+            search = self.quality_search(arr)
+            quality = search.max_quality(self.max_bytes, guess=self.quality)
+            self.quality = MIN_QUALITY if quality is None else quality
+            return search.encode(self.quality)
+        self._tile_plan.tile(arr, out=self._img)
+        client_bytes = _jpeg_encode(self._img, self.quality)
         return client_bytes
 
+    def quality_search(self, arr: np.ndarray) -> "JpegQualitySearch":
+        """Search over qualities at which to encode tensor.
+
+        The search reads the reused padded image, so it must not be used
+        once another tensor has been encoded.
+        """
+        self._tile_plan.tile(arr, out=self._img)
+        return JpegQualitySearch(self._img)
+
+
+class JpegGrayPostencoder(JpegPostencoder):
+    """Encodes tiled tensor as single-channel (grayscale) JPEG.
+
+    Unlike an RGB JPEG, no chroma is encoded or sent.
+    """
+
+    CHANNELS = None
+
+
+class JpegQualitySearch:
+    """Search over the quality at which to encode an image as JPEG.
+
+    Each quality is encoded at most once, and its encoding cached. JPEG
+    size is assumed not to decrease as quality increases.
+    """
+
+    def __init__(self, arr: np.ndarray):
+        self._img = Image.fromarray(arr)
+        self._encoded: Dict[int, ByteString] = {}
+
+    @property
+    def num_encodes(self) -> int:
+        return len(self._encoded)
+
+    def encode(self, quality: int) -> ByteString:
+        encoded = self._encoded.get(quality)
+        if encoded is None:
+            encoded = _jpeg_save(self._img, quality)
+            self._encoded[quality] = encoded
+        return encoded
+
+    def max_quality(
+        self,
+        max_bytes: int,
+        guess: int = None,
+        lo: int = None,
+        hi: int = None,
+    ) -> Optional[int]:
+        """Highest quality in [lo, hi] whose JPEG fits within max_bytes.
+
+        Without a guess, this bisects the whole range, taking about
+        log2(hi - lo) encodes. With a guess, the search steps away from
+        it in doubling strides until the answer is bracketed, and then
+        bisects, so a guess that is right or close takes only a few
+        encodes.
+
+        Returns:
+            Optional[int]: quality, or None if even lo does not fit
+        """
+        lo = MIN_QUALITY if lo is None else lo
+        hi = MAX_QUALITY if hi is None else hi
+
+        def fits(quality: int) -> bool:
+            return len(self.encode(quality)) <= max_bytes
+
+        # Invariant: good fits (or is lo - 1), bad does not (or is hi + 1)
+        good, bad = lo - 1, hi + 1
+        if guess is not None:
+            guess = min(max(guess, lo), hi)
+            stride = 1
+            if fits(guess):
+                good = guess
+                while good + stride < bad and fits(good + stride):
+                    good += stride
+                    stride *= 2
+                bad = min(good + stride, bad)
+            else:
+                bad = guess
+                while bad - stride > good and not fits(bad - stride):
+                    bad -= stride
+                    stride *= 2
+                good = max(bad - stride, good)
+
+        while bad - good > 1:
+            mid = (good + bad) // 2
+            if fits(mid):
+                good = mid
+            else:
+                bad = mid
+        return None if good < lo else good
+
 
 def _jpeg_encode(arr: np.ndarray, quality: int) -> ByteString:
-    img = Image.fromarray(arr)
+    return _jpeg_save(Image.fromarray(arr), quality)
+
+
+def _jpeg_save(img: Image.Image, quality: int) -> ByteString:
     with BytesIO() as buf:
         img.save(buf, "JPEG", quality=quality)
         buf.seek(0)
         return buf.read()
-
-
-def _pad(img: np.ndarray, mbu_size: int) -> np.ndarray:
-    py = -img.shape[0] % mbu_size
-    px = -img.shape[1] % mbu_size
-    return np.pad(img, ((0, py), (0, px), (0, 0)))
@@ -1,12 +1,18 @@
+import os
+import threading
+import time
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, wait
 from io import BytesIO
 from math import ceil
 from typing import (
     Awaitable,
     ByteString,
+    Callable,
     Dict,
     Generator,
     Generic,
     List,
+    Sequence,
     Tuple,
     TypeVar,
 )
@@ -16,13 +22,27 @@ import tensorflow as tf
 from PIL import Image
 
 from src.lib.layouts import TensorLayout, TiledArrayLayout
-from src.lib.tile import detile
+from src.lib.tile import tile_plan
 
 
 class Predecoder:
     def run(self, buf: ByteString) -> np.ndarray:
         raise NotImplementedError
 
+    def shape(self, buf: ByteString) -> Tuple[int, ...]:
+        """Shape of tensor that buffer predecodes into."""
+        raise NotImplementedError
+
+    def run_into(self, buf: ByteString, out: np.ndarray):
+        """Predecode into given tensor."""
+        out[...] = self.run(buf)
+
+    def run_many(
+        self, bufs: Sequence[ByteString], executor: Executor = None
+    ) -> np.ndarray:
+        """Predecode buffers into a batch tensor, in parallel."""
+        return predecode_batch([self] * len(bufs), bufs, executor)
+
 
 class TensorPredecoder(Predecoder):
     def __init__(self, shape: tuple, dtype: type):
@@ -32,6 +52,13 @@ class TensorPredecoder(Predecoder):
     def run(self, buf: ByteString) -> np.ndarray:
         return np.frombuffer(buf, dtype=self._dtype).reshape(self._shape)
 
+    def shape(self, buf: ByteString) -> Tuple[int, ...]:
+        if -1 not in self._shape:
+            return tuple(self._shape)
+        size = len(buf) // np.dtype(self._dtype).itemsize
+        known = int(np.prod([x for x in self._shape if x != -1]))
+        return tuple(size // known if x == -1 else x for x in self._shape)
+
 
 class RgbPredecoder(Predecoder):
     def __init__(self, shape: tuple, dtype: type):
@@ -45,6 +72,12 @@ class RgbPredecoder(Predecoder):
             .astype(self._dtype)
         )
 
+    def run_into(self, buf: ByteString, out: np.ndarray):
+        out[...] = np.frombuffer(buf, dtype=np.uint8).reshape(self._shape)
+
+    def shape(self, buf: ByteString) -> Tuple[int, ...]:
+        return tuple(self._shape)
+
 
 class JpegPredecoder(Predecoder):
     MBU_SIZE = 16
@@ -54,19 +87,41 @@ class JpegPredecoder(Predecoder):
     ):
         self._tiled_layout = tiled_layout
         self._tensor_layout = tensor_layout
+        self._tile_plan = tile_plan(tensor_layout, tiled_layout)
+        shape = tiled_layout.shape
+        self._padded_shape = tuple(
+            ceil(x / self.MBU_SIZE) * self.MBU_SIZE for x in shape
+        )
 
     def run(self, buf: ByteString) -> np.ndarray:
-        img = _decode_raw_img(buf)
-        img = np.array(img)[..., 0]
-        img = self._trim(img)
-        tensor = detile(img, self._tiled_layout, self._tensor_layout)
-        return tensor
+        return self._tile_plan.detile(self._decode(buf))
+
+    def run_into(self, buf: ByteString, out: np.ndarray):
+        self._tile_plan.detile(self._decode(buf), out=out)
+
+    def shape(self, buf: ByteString) -> Tuple[int, ...]:
+        return self._tensor_layout.shape
 
-    def _trim(self, img: np.ndarray) -> np.ndarray:
-        shape = self._tiled_layout.shape
-        expect = tuple(ceil(x / self.MBU_SIZE) * self.MBU_SIZE for x in shape)
-        assert expect == img.shape
-        return img[: shape[0], : shape[1]]
+    def _decode(self, buf: ByteString) -> np.ndarray:
+        """Decode padded tiled array."""
+        img = np.asarray(_decode_raw_img(buf))
+        assert img.shape[:2] == self._padded_shape
+        # Tiles are read straight from the first channel of the padded
+        # image, without trimming or copying it first
+        return img[..., 0]
+
+
+class JpegGrayPredecoder(JpegPredecoder):
+    """Decodes only the luma of JPEG.
+
+    Suits grayscale JPEGs, as well as color JPEGs with neutral chroma
+    (such as those of the Android client), whose chroma is skipped.
+    """
+
+    def _decode(self, buf: ByteString) -> np.ndarray:
+        img = np.asarray(_decode_raw_img(buf, mode="L"))
+        assert img.shape == self._padded_shape
+        return img
 
 
 class JpegRgbPredecoder(Predecoder):
@@ -77,6 +132,113 @@ class JpegRgbPredecoder(Predecoder):
         img = _decode_raw_img(buf)
         return np.array(img).astype(self._tensor_layout.dtype)
 
+    def run_into(self, buf: ByteString, out: np.ndarray):
+        out[...] = np.asarray(_decode_raw_img(buf))
+
+    def shape(self, buf: ByteString) -> Tuple[int, ...]:
+        return self._tensor_layout.shape
+
+
+class PredecodeBatch:
+    """Batch tensor into which buffers are predecoded as they are added.
+
+    The first buffer is predecoded on the calling thread, to determine the
+    shape of the batch. The rest are predecoded straight into the batch on
+    the executor (a shared pool by default), since PIL and NumPy release
+    the GIL while decoding and copying. Buffers must remain valid until
+    result returns.
+
+    Room is first made for the expected number of buffers (at most
+    capacity), and grown as more are added, so that the batch tensor has
+    no unused slots when as many buffers as expected arrive.
+    """
+
+    def __init__(
+        self, capacity: int, executor: Executor = None, expected: int = None
+    ):
+        self.capacity = capacity
+        self.expected = capacity if expected is None else expected
+        self._executor = _executor() if executor is None else executor
+        self._batch: np.ndarray = None
+        self._futures: List[Future] = []
+        self._first_time: float = None
+
+    def __len__(self) -> int:
+        return 0 if self._batch is None else 1 + len(self._futures)
+
+    def add(self, predecoder: Predecoder, buf: ByteString):
+        """Predecode buffer into next slot of batch.
+
+        Raises if the first buffer fails to predecode, in which case the
+        batch remains empty.
+        """
+        assert len(self) < self.capacity
+        if self._batch is None:
+            t = time.monotonic()
+            first = predecoder.run(buf)
+            size = max(1, min(self.expected, self.capacity))
+            self._batch = np.empty((size, *first.shape), dtype=first.dtype)
+            self._batch[0] = first
+            self._first_time = time.monotonic() - t
+            return
+        if len(self) == len(self._batch):
+            self._grow()
+        out = self._batch[len(self)]
+        self._futures.append(
+            self._executor.submit(_timed, predecoder.run_into, buf, out)
+        )
+
+    def _grow(self):
+        # Buffers still predecoding into the old batch must finish first
+        wait(self._futures)
+        size = min(2 * len(self._batch), self.capacity)
+        batch = np.empty((size, *self._batch.shape[1:]), self._batch.dtype)
+        batch[: len(self._batch)] = self._batch
+        self._batch = batch
+
+    def errors(self) -> Dict[int, BaseException]:
+        """Wait for predecoding to finish, and return the error of each
+        buffer (by index) that failed to predecode."""
+        wait(self._futures)
+        return {
+            i: x.exception()
+            for i, x in enumerate(self._futures, 1)
+            if x.exception() is not None
+        }
+
+    def result(self) -> Tuple[np.ndarray, List[float]]:
+        """Wait for predecoding to finish.
+
+        Buffers that failed to predecode are left out of the batch.
+
+        Returns:
+            np.ndarray: batch tensor
+            List[float]: time (s) taken to predecode each buffer
+        """
+        errors = self.errors()
+        batch = self._batch[: len(self)]
+        times = [self._first_time] + [
+            x.result() for x in self._futures if x.exception() is None
+        ]
+        if len(errors) != 0:
+            batch = np.delete(batch, list(errors), axis=0)
+        return batch, times
+
+
+def predecode_batch(
+    predecoders: Sequence[Predecoder],
+    bufs: Sequence[ByteString],
+    executor: Executor = None,
+) -> np.ndarray:
+    """Predecode each buffer by its predecoder, into a new batch tensor."""
+    batch = PredecodeBatch(len(bufs), executor)
+    for predecoder, buf in zip(predecoders, bufs):
+        batch.add(predecoder, buf)
+    for error in batch.errors().values():
+        raise error
+    data_tensor, _ = batch.result()
+    return data_tensor
+
 
 def to_np_dtype(dtype: type) -> type:
     return {
@@ -89,8 +251,37 @@ def to_np_dtype(dtype: type) -> type:
     }[dtype]
 
 
-def _decode_raw_img(buf: ByteString) -> Image.Image:
+def _timed(fn: Callable, *args) -> float:
+    t = time.monotonic()
+    fn(*args)
+    return time.monotonic() - t
+
+
+_shared_executor: ThreadPoolExecutor = None
+_shared_executor_lock = threading.Lock()
+
+
+def _executor() -> ThreadPoolExecutor:
+    global _shared_executor
+    with _shared_executor_lock:
+        if _shared_executor is None:
+            _shared_executor = ThreadPoolExecutor(
+                max_workers=os.cpu_count(), thread_name_prefix="predecode"
+            )
+    return _shared_executor
+
+
+def _decode_raw_img(buf: ByteString, mode: str = None) -> Image.Image:
+    """Decode image, in given mode if any.
+
+    JPEG decoders are asked to decode straight into the given mode, which
+    for "L" skips decoding chroma and converting color.
+    """
     with BytesIO(buf) as stream:
         img = Image.open(stream)
+        if mode is not None:
+            img.draft(mode, img.size)
         img.load()
+    if mode is not None and img.mode != mode:
+        img = img.convert(mode)
     return img
@@ -0,0 +1,76 @@
+import json
+from functools import lru_cache
+from typing import List, Sequence, Tuple
+
+import numpy as np
+from tensorflow import keras
+from tensorflow.keras.applications import imagenet_utils
+
+# (name, description) of each class
+Labels = Sequence[Tuple[str, str]]
+
+
+class PredictionDecoder:
+    """Decodes batches of class scores into top predictions.
+
+    If labels are not given, classes are labelled by their index.
+    """
+
+    def __init__(self, labels: Labels = None):
+        self.labels = None if labels is None else list(labels)
+
+    @staticmethod
+    def from_class_index(path: str) -> "PredictionDecoder":
+        """Read labels from Keras class index file.
+
+        The file maps class indices to [name, description] pairs.
+        """
+        with open(path) as f:
+            class_index = json.load(f)
+        labels = [tuple(class_index[str(i)]) for i in range(len(class_index))]
+        return PredictionDecoder(labels)
+
+    def top_k(
+        self, predictions: np.ndarray, k: int = 3
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Class indices and scores of top k predictions of each row."""
+        k = min(k, predictions.shape[-1])
+        idxs = np.argpartition(predictions, -k, axis=-1)[:, -k:]
+        scores = np.take_along_axis(predictions, idxs, axis=-1)
+        order = np.argsort(-scores, axis=-1)
+        indices = np.take_along_axis(idxs, order, axis=-1)
+        scores = np.take_along_axis(scores, order, axis=-1)
+        return indices, scores
+
+    def label(
+        self, indices: np.ndarray, scores: np.ndarray
+    ) -> List[List[Tuple[str, str, float]]]:
+        """Attach labels to class indices and scores of each row."""
+        if self.labels is None:
+            return [
+                [(str(i), str(i), score) for i, score in zip(*row)]
+                for row in zip(indices.tolist(), scores.tolist())
+            ]
+        labels = self.labels
+        return [
+            [(*labels[i], score) for i, score in zip(*row)]
+            for row in zip(indices.tolist(), scores.tolist())
+        ]
+
+    def decode(
+        self, predictions: np.ndarray, k: int = 3
+    ) -> List[List[Tuple[str, str, float]]]:
+        """Labelled top k predictions of each row."""
+        return self.label(*self.top_k(predictions, k))
+
+
+@lru_cache(maxsize=None)
+def imagenet_decoder() -> PredictionDecoder:
+    """Decoder for ImageNet classifier heads, with labels read once."""
+    path = keras.utils.get_file(
+        "imagenet_class_index.json",
+        imagenet_utils.CLASS_INDEX_PATH,
+        cache_subdir="models",
+        file_hash="c2c37ea517e94d9795004a39431a14cb",
+    )
+    return PredictionDecoder.from_class_index(path)
@@ -79,6 +79,37 @@ def split_model(
     return model1, model2, model3
 
 
+def split_server_model(
+    model: keras.Model,
+    layer: str,
+    encoder: Optional[Layer] = None,
+    decoder: Optional[Layer] = None,
+) -> keras.Model:
+    """Build server-side model of model split by given layer name.
+
+    Unlike split_model, only the server-side graph is built. Its layers
+    are those of the given model, so weights are shared rather than
+    copied. The encoder is only used to determine the input dtype.
+    """
+    split_layer = model.layers[_get_layer_idx_by_name(model, layer)]
+    last_layer = model.layers[-1]
+    shape = _output_shape(split_layer)
+
+    x = keras.Input(shape, dtype=split_layer.output.dtype)
+    if encoder is not None:
+        x = encoder(x)
+
+    x = keras.Input(shape, dtype=x.dtype)
+    inputs = x
+
+    if decoder is not None:
+        x = decoder(x)
+
+    outputs = _copy_graph(last_layer, {split_layer.name: x})
+
+    return keras.Model(inputs=inputs, outputs=outputs)
+
+
 def copy_model(model: keras.Model) -> keras.Model:
     # return keras.models.clone_model(model)
     layers = model.layers
@@ -9,6 +9,123 @@ import numpy as np
 from src.lib.layouts import TensorLayout, TiledArrayLayout
 
 
+class TilePlan:
+    """Tiling between a tensor layout and a tiled array layout.
+
+    Layouts are validated once, when the plan is created. Each tile or
+    detile is then a single copy between views of its input and output,
+    so that the output may be a reusable buffer (see new_tiled).
+
+    Plans hold no buffers, so a plan may be shared between threads. Use
+    tile_plan to retrieve cached plans.
+    """
+
+    def __init__(
+        self, tensor_layout: TensorLayout, tiled_layout: TiledArrayLayout
+    ):
+        order = tensor_layout.order
+        assert tensor_layout.shape == tiled_layout.orig_shape_in_order(order)
+        assert tiled_layout.c <= tiled_layout.nrows * tiled_layout.ncols
+        self.tensor_layout = tensor_layout
+        self.tiled_layout = tiled_layout
+
+    def tile(self, arr: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        """Tiles tensor into 2D image.
+
+        Args:
+            arr: tensor
+            out: array to write tiled array into, at its top-left. It may
+                be larger than the tiled array, and may have a trailing
+                channel axis, whose channels all receive the same values.
+                Areas not covered by tiles are left untouched.
+
+        Returns:
+            np.ndarray: out, or a new tiled array if out is not given
+        """
+        assert arr.shape == self.tensor_layout.shape
+        if out is None:
+            out = np.zeros(self.tiled_layout.shape, dtype=arr.dtype)
+        src = _as_chw(arr, self.tensor_layout.order)
+        dst = self._tiles(out)
+        if out.ndim == 3:
+            src = src[..., np.newaxis]
+        for s, d in self._pairs(src, dst):
+            np.copyto(d, s)
+        return out
+
+    def detile(self, arr: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        """Detiles 2D image into tensor.
+
+        Args:
+            arr: tiled array, which may be larger than the tiled layout
+                (e.g. padded); only its top-left is read
+            out: tensor to write into
+
+        Returns:
+            np.ndarray: out, or else a new tensor. A new tensor is laid
+                out in memory as chw, since tiles are then contiguous.
+        """
+        order = self.tensor_layout.order
+        if out is None:
+            shape = self.tensor_layout.shape_in_order("chw")
+            dst = np.empty(shape, dtype=arr.dtype)
+            out = _as_order(dst, "chw", order)
+        else:
+            assert out.shape == self.tensor_layout.shape
+            dst = _as_chw(out, order)
+        src = self._tiles(arr)
+        for d, s in self._pairs(dst, src):
+            np.copyto(d, s)
+        return out
+
+    def new_tiled(
+        self, dtype: type, pad_to: int = 1, channels: int = None
+    ) -> np.ndarray:
+        """Zeroed array that tiled arrays may be written into.
+
+        Its height and width are padded to multiples of pad_to. If
+        channels is given, it has a trailing channel axis.
+        """
+        shape = tuple(
+            math.ceil(x / pad_to) * pad_to for x in self.tiled_layout.shape
+        )
+        if channels is not None:
+            shape = (*shape, channels)
+        return np.zeros(shape, dtype=dtype)
+
+    def _tiles(self, arr: np.ndarray) -> np.ndarray:
+        """View of tiled area of array, as (nrows, h, ncols, w, ...)."""
+        layout = self.tiled_layout
+        ny, nx = layout.shape
+        assert arr.shape[0] >= ny and arr.shape[1] >= nx
+        return _reshaped_view(
+            arr[:ny, :nx],
+            (layout.nrows, layout.h, layout.ncols, layout.w, *arr.shape[2:]),
+        )
+
+    def _pairs(self, chw: np.ndarray, tiles: np.ndarray):
+        """Yields corresponding views of chw tensor and of tiles.
+
+        Full rows of tiles are paired first, then the final partial row.
+        """
+        c = self.tiled_layout.c
+        ncols = self.tiled_layout.ncols
+        k, r = divmod(c, ncols)
+        if k != 0:
+            rows = _reshaped_view(chw[: k * ncols], (k, ncols, *chw.shape[1:]))
+            yield rows.swapaxes(1, 2), tiles[:k]
+        if r != 0:
+            yield chw[k * ncols : c].swapaxes(0, 1), tiles[k, :, :r]
+
+
+@functools.lru_cache(maxsize=None)
+def tile_plan(
+    tensor_layout: TensorLayout, tiled_layout: TiledArrayLayout
+) -> TilePlan:
+    """Cached tile plan of given layout pair."""
+    return TilePlan(tensor_layout, tiled_layout)
+
+
 def tile(
     arr: np.ndarray, in_layout: TensorLayout, out_layout: TiledArrayLayout
 ) -> np.ndarray:
@@ -22,36 +139,7 @@ def tile(
     Returns:
         np.ndarray: tiled array
     """
-    assert in_layout.shape == out_layout.orig_shape_in_order(in_layout.order)
-    assert arr.shape == in_layout.shape
-    arr = _as_chw(arr, in_layout.order)
-    arr = _tile_chw(arr, out_layout.nrows, out_layout.ncols)
-    assert arr.shape == out_layout.shape
-    return arr
-
-
-def _tile_chw(arr: np.ndarray, nrows: int, ncols: int) -> np.ndarray:
-    """
-    Args:
-        arr: chw tensor
-        nrows: number of tiled rows
-        ncols: number of tiled columns
-
-    Returns:
-        np.ndarray: tiled array
-    """
-    c, h, w = arr.shape
-    assert c <= nrows * ncols
-
-    if c < nrows * ncols:
-        arr = arr.reshape(-1).copy()
-        arr.resize(nrows * ncols * h * w)
-
-    return (
-        arr.reshape(nrows, ncols, h, w)
-        .swapaxes(1, 2)
-        .reshape(nrows * h, ncols * w)
-    )
+    return tile_plan(in_layout, out_layout).tile(arr)
 
 
 def detile(
@@ -67,35 +155,15 @@ def detile(
     Returns:
         np.ndarray: tensor
     """
-    assert out_layout.shape == in_layout.orig_shape_in_order(out_layout.order)
     assert arr.shape == in_layout.shape
-    arr = _detile_chw(arr, **in_layout.__dict__)
-    arr = _as_order(arr, "chw", out_layout.order)
-    assert arr.shape == out_layout.shape
-    return arr
-
+    return tile_plan(out_layout, in_layout).detile(arr)
 
-def _detile_chw(
-    arr: np.ndarray, c: int, h: int, w: int, nrows: int, ncols: int, **kwargs
-) -> np.ndarray:
-    """
-    Args:
-        arr: tiled array
-        c: channels (number of tiles to keep)
-        h: height of tile
-        w: width of tile
-        nrows: number of tiled rows
-        ncols: number of tiled columns
 
-    Returns:
-        np.ndarray: chw tensor
-    """
-    return (
-        arr.reshape(nrows, h, ncols, w)
-        .swapaxes(1, 2)
-        .reshape(-1)[: c * h * w]
-        .reshape(c, h, w)
-    )
+def _reshaped_view(arr: np.ndarray, shape: Tuple[int, ...]) -> np.ndarray:
+    """Reshape without copying, so that writes reach the original."""
+    view = arr.view()
+    view.shape = shape
+    return view
 
 
 def _as_order(arr: np.ndarray, in_order: str, out_order: str) -> np.ndarray:
@@ -2,7 +2,7 @@ from __future__ import annotations
 
 import json
 from dataclasses import asdict, dataclass, field
-from typing import Any, Dict
+from typing import Any, Dict, List
 
 
 @dataclass(eq=True, frozen=True)
@@ -66,10 +66,31 @@ class PostencoderConfig:
 class ProcessorConfig:
     model_config: ModelConfig
     postencoder_config: PostencoderConfig
+    # Format of confirmations and results sent to client: json or binary
+    result_format: str = "json"
+    # Include pipeline stage timings in json results
+    timings: bool = False
 
     @staticmethod
     def from_json_dict(d: Dict[str, Any]) -> ProcessorConfig:
         return ProcessorConfig(
             ModelConfig.from_json_dict(d["model_config"]),
             PostencoderConfig.from_json_dict(d["postencoder_config"]),
+            d.get("result_format", "json"),
+            d.get("timings", False),
         )
+
+
+def read_model_configs(
+    filename: str = "models.json",
+) -> Dict[str, List[ModelConfig]]:
+    """Read model configs listed for each model name."""
+    with open(filename) as f:
+        d = json.load(f)
+    return {
+        model_name: [
+            ModelConfig(model=model_name, **config_dict)
+            for config_dict in config_dicts
+        ]
+        for model_name, config_dicts in d.items()
+    }
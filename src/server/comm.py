@@ -1,8 +1,31 @@
+import asyncio
 import json
-from typing import List, Tuple
+import struct
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
 
 from src.modelconfig import ModelConfig
 
+# Binary messages start with a type byte, which never collides with the
+# opening brace of JSON messages. All fields are big-endian.
+BINARY_CONFIRMATION = 1
+BINARY_RESULT = 2
+BINARY_DROPPED = 3
+
+# type, frameNumber, numBytes
+_confirmation_header = struct.Struct(">BII")
+# type, frameNumber, inferenceTime, numPredictions
+_result_header = struct.Struct(">BIIB")
+# type, frameNumber, numBytes
+_dropped_header = struct.Struct(">BII")
+
+# JSON type and header of each binary message type, besides results
+_binary_headers = {
+    BINARY_CONFIRMATION: ("confirmation", _confirmation_header),
+    BINARY_DROPPED: ("dropped", _dropped_header),
+}
+
 
 def json_confirmation(frame_number: int, num_bytes: int) -> str:
     return json.dumps(
@@ -14,6 +37,12 @@ def json_confirmation(frame_number: int, num_bytes: int) -> str:
     )
 
 
+def json_dropped(frame_number: int, num_bytes: int) -> str:
+    return json.dumps(
+        {"type": "dropped", "frameNumber": frame_number, "numBytes": num_bytes}
+    )
+
+
 def json_ping(id_) -> str:
     return json.dumps({"type": "ping", "id": id_})
 
@@ -30,17 +59,80 @@ def json_result(
     # feed_time: int,
     inference_time: int,
     predictions: List[Tuple[str, str, float]],
+    timings: Dict[str, float] = None,
 ) -> str:
-    return json.dumps(
-        {
+    """Result message, optionally with the time (ms) at which the frame
+    reached each pipeline stage, relative to when it began to be read."""
+    d = {
+        "type": "result",
+        "frameNumber": frame_number,
+        # "readTime": read_time,  # TODO?
+        # "feedTime": feed_time,
+        "inferenceTime": inference_time,
+        "predictions": [
+            {"name": name, "description": desc, "score": score}
+            for name, desc, score in predictions
+        ],
+    }
+    if timings is not None:
+        d["timings"] = timings
+    return json.dumps(d)
+
+
+def binary_confirmation(frame_number: int, num_bytes: int) -> bytes:
+    return _confirmation_header.pack(
+        BINARY_CONFIRMATION, frame_number, num_bytes
+    )
+
+
+def binary_dropped(frame_number: int, num_bytes: int) -> bytes:
+    return _dropped_header.pack(BINARY_DROPPED, frame_number, num_bytes)
+
+
+def binary_result(
+    frame_number: int,
+    inference_time: int,
+    indices: np.ndarray,
+    scores: np.ndarray,
+) -> bytes:
+    """Result header, followed by class indices (uint16) and scores
+    (float32) of the top predictions. Labels are resolved client-side."""
+    header = _result_header.pack(
+        BINARY_RESULT, frame_number, inference_time, len(indices)
+    )
+    indices = indices.astype(">u2").tobytes()
+    scores = scores.astype(">f4").tobytes()
+    return b"".join((header, indices, scores))
+
+
+async def read_message(reader: asyncio.StreamReader) -> Optional[dict]:
+    """Read next message from the server, in the form its JSON variant
+    decodes to, or None once the connection is closed.
+
+    Binary results carry class indices and scores ("indices", "scores")
+    in place of labelled predictions.
+    """
+    first = await reader.read(1)
+    if len(first) == 0:
+        return None
+    if first[0] == BINARY_RESULT:
+        data = first + await reader.readexactly(_result_header.size - 1)
+        _, frame_number, inference_time, k = _result_header.unpack(data)
+        data = await reader.readexactly(6 * k)
+        return {
             "type": "result",
             "frameNumber": frame_number,
-            # "readTime": read_time,  # TODO?
-            # "feedTime": feed_time,
             "inferenceTime": inference_time,
-            "predictions": [
-                {"name": name, "description": desc, "score": score}
-                for name, desc, score in predictions
-            ],
+            "indices": np.frombuffer(data[: 2 * k], ">u2").tolist(),
+            "scores": np.frombuffer(data[2 * k :], ">f4").tolist(),
         }
-    )
+    if first[0] in _binary_headers:
+        type_, header = _binary_headers[first[0]]
+        data = first + await reader.readexactly(header.size - 1)
+        _, frame_number, num_bytes = header.unpack(data)
+        return {
+            "type": type_,
+            "frameNumber": frame_number,
+            "numBytes": num_bytes,
+        }
+    return json.loads(first + await reader.readline())
@@ -0,0 +1,78 @@
+import itertools
+import logging
+import queue
+from dataclasses import dataclass
+from logging.handlers import QueueHandler, QueueListener
+from typing import TextIO
+
+FORMAT = (
+    "%(asctime)s %(levelname)s [%(processName)s/%(threadName)s] "
+    "%(name)s: %(message)s"
+)
+
+# Per-frame events, sampled so that high frame rates do not flood the log
+frame_logger = logging.getLogger("src.server.frames")
+
+# Records of all threads, and of worker processes, are written out from
+# this queue by a single listener thread
+_queue = queue.SimpleQueue()
+
+
+@dataclass
+class LogConfig:
+    level: int = logging.INFO
+    # Log only every nth per-frame event
+    sample_every: int = 1
+
+
+_config = LogConfig()
+
+
+class SampleFilter(logging.Filter):
+    """Lets through only every nth record."""
+
+    def __init__(self, every: int):
+        super().__init__()
+        self.every = every
+        self._counter = itertools.count()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return next(self._counter) % self.every == 0
+
+
+def setup_logging(config: LogConfig, stream: TextIO = None) -> QueueListener:
+    """Log to stream (stderr by default) from a listener thread.
+
+    Logging threads only hand records to a queue, so they never block on
+    terminal I/O.
+    """
+    global _config
+    _config = config
+    _setup(config, QueueHandler(_queue))
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter(FORMAT))
+    listener = QueueListener(_queue, handler)
+    listener.start()
+    return listener
+
+
+def setup_worker_logging(config: LogConfig, forward):
+    """Forward records of a worker process to the parent's log queue."""
+    _setup(config, QueueHandler(forward))
+
+
+def log_queue() -> queue.SimpleQueue:
+    """Queue from which records are written out."""
+    return _queue
+
+
+def log_config() -> LogConfig:
+    """Config given to setup_logging, for worker processes to use."""
+    return _config
+
+
+def _setup(config: LogConfig, handler: logging.Handler):
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(config.level)
+    frame_logger.filters[:] = [SampleFilter(config.sample_every)]
@@ -0,0 +1,329 @@
+import threading
+from asyncio import StreamReader, StreamWriter
+from bisect import bisect_left
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+
+from src.modelconfig import ModelConfig
+
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+class _ShardedValues:
+    """Fixed number of float values, updated without locks.
+
+    Each thread updates only its own shard, so increments from different
+    threads never race. Reads sum over all shards.
+    """
+
+    def __init__(self, size: int):
+        self._size = size
+        self._local = threading.local()
+        self._shards: List[List[float]] = []
+
+    def add(self, idx: int, value: float):
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = [0.0] * self._size
+            self._local.shard = shard
+            self._shards.append(shard)
+        shard[idx] += value
+
+    def values(self) -> List[float]:
+        return [sum(xs) for xs in zip(*self._shards)] or [0.0] * self._size
+
+
+class Metric:
+    """Family of metrics of the same name, distinguished by labels."""
+
+    kind: str
+
+    def __init__(
+        self, name: str, description: str, labelnames: Sequence[str] = ()
+    ):
+        self.name = name
+        self.help = description
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        if len(self.labelnames) == 0:
+            self._default = self.labels()
+
+    def labels(self, *labelvalues: str):
+        key = tuple(str(x) for x in labelvalues)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def samples(self) -> Iterator[Tuple[str, Dict[str, str], float]]:
+        """Yields (suffix, labels, value) of each sample."""
+        for key, child in list(self._children.items()):
+            labels = dict(zip(self.labelnames, key))
+            for suffix, extra, value in self._child_samples(child):
+                yield suffix, {**labels, **extra}, value
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _child_samples(self, child):
+        raise NotImplementedError
+
+
+class _CounterChild:
+    def __init__(self):
+        self._values = _ShardedValues(1)
+
+    def inc(self, amount: float = 1.0):
+        self._values.add(0, amount)
+
+    def get(self) -> float:
+        return self._values.values()[0]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0):
+        self._default.inc(amount)
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def _child_samples(self, child: _CounterChild):
+        yield "", {}, child.get()
+
+
+class Gauge(Metric):
+    """Gauge whose value is computed by a callback when collected."""
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        collect: Callable[[], Dict[Tuple[str, ...], float]],
+        labelnames: Sequence[str] = (),
+    ):
+        self._collect = collect
+        super().__init__(name, description, labelnames)
+
+    def samples(self):
+        for key, value in self._collect().items():
+            yield "", dict(zip(self.labelnames, key)), value
+
+    def _new_child(self):
+        return None
+
+
+class _HistogramChild:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        # Count per bucket (and +Inf), then sum
+        self._values = _ShardedValues(len(buckets) + 2)
+
+    def observe(self, value: float, count: int = 1):
+        """Observe value, count times."""
+        self._values.add(bisect_left(self.buckets, value), count)
+        self._values.add(len(self.buckets) + 1, value * count)
+
+    def get(self) -> Tuple[List[float], float]:
+        values = self._values.values()
+        return values[:-1], values[-1]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        self.buckets = tuple(buckets)
+        super().__init__(name, description, labelnames)
+
+    def observe(self, value: float, count: int = 1):
+        self._default.observe(value, count)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def _child_samples(self, child: _HistogramChild):
+        counts, total = child.get()
+        cumulative = 0.0
+        for le, count in zip((*self.buckets, "+Inf"), counts):
+            cumulative += count
+            yield "_bucket", {"le": str(le)}, cumulative
+        yield "_sum", {}, total
+        yield "_count", {}, cumulative
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def exposition(self) -> str:
+        """Metrics in Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, labels, value in metric.samples():
+                lines.append(
+                    f"{metric.name}{suffix}{_format_labels(labels)} {value}"
+                )
+        return "\n".join(lines) + "\n"
+
+
+class ServerMetrics:
+    """Metrics of the inference server.
+
+    Methods may be called from any thread. Process workers forward calls
+    to the parent process.
+    """
+
+    def __init__(self):
+        self.registry = Registry()
+        register = self.registry.register
+        self.frames_received = register(
+            Counter("ci_frames_received_total", "Frames received")
+        )
+        self.frames_dropped = register(
+            Counter("ci_frames_dropped_total", "Frames dropped unprocessed")
+        )
+        self.bytes_received = register(
+            Counter("ci_bytes_received_total", "Frame bytes received")
+        )
+        self.bytes_sent = register(
+            Counter("ci_bytes_sent_total", "Bytes sent to clients")
+        )
+        self.model_loads = register(
+            Counter("ci_model_loads_total", "Models loaded", ["model"])
+        )
+        self.model_load_seconds = register(
+            Histogram(
+                "ci_model_load_seconds",
+                "Time to load and warm up model",
+                buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 50.0, 100.0),
+            )
+        )
+        self.model_evictions = register(
+            Counter("ci_model_evictions_total", "Models evicted", ["model"])
+        )
+        self.frames_inferred = register(
+            Counter("ci_frames_inferred_total", "Frames inferred", ["model"])
+        )
+        self.inference_seconds = register(
+            Histogram(
+                "ci_inference_seconds",
+                "Time per batched forward pass, observed once per frame",
+                ["model"],
+            )
+        )
+
+    def add_gauge(
+        self,
+        name: str,
+        description: str,
+        collect: Callable[[], float],
+    ):
+        """Register gauge computed by callback when collected."""
+        gauge = Gauge(name, description, lambda: {(): collect()})
+        self.registry.register(gauge)
+
+    def frame_received(self, num_bytes: int):
+        self.frames_received.inc()
+        self.bytes_received.inc(num_bytes)
+
+    def frame_dropped(self):
+        self.frames_dropped.inc()
+
+    def sent(self, num_bytes: int):
+        self.bytes_sent.inc(num_bytes)
+
+    def model_loaded(self, model_config: ModelConfig, seconds: float):
+        self.model_loads.labels(_model_label(model_config)).inc()
+        self.model_load_seconds.observe(seconds)
+
+    def model_evicted(self, model_config: ModelConfig):
+        self.model_evictions.labels(_model_label(model_config)).inc()
+
+    def inferred(
+        self, model_config: ModelConfig, seconds: float, batch_size: int
+    ):
+        model = _model_label(model_config)
+        self.frames_inferred.labels(model).inc(batch_size)
+        self.inference_seconds.labels(model).observe(seconds, batch_size)
+
+
+def _model_label(model_config: ModelConfig) -> str:
+    return model_config.to_path()
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if len(labels) == 0:
+        return ""
+    pairs = ",".join(
+        f'{k}="{_escape(v)}"' for k, v in sorted(labels.items())
+    )
+    return f"{{{pairs}}}"
+
+
+def _escape(value: str) -> str:
+    return (
+        value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    )
+
+
+def handle_client(server_metrics: ServerMetrics):
+    """Serve metrics over HTTP, at /metrics."""
+
+    async def client_handler(reader: StreamReader, writer: StreamWriter):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin1").split()
+            if len(parts) >= 2 and parts[1].split("?")[0] == "/metrics":
+                status = "200 OK"
+                body = server_metrics.registry.exposition().encode("utf8")
+            else:
+                status = "404 Not Found"
+                body = b"Not found\n"
+            header = (
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n"
+            )
+            writer.write(header.encode("latin1") + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    return client_handler
@@ -1,107 +1,406 @@
+import gc
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
 from typing import (
     Awaitable,
     ByteString,
+    Callable,
     Dict,
     Generator,
     Generic,
     List,
+    Optional,
     Tuple,
     TypeVar,
+    Union,
 )
 
 import numpy as np
 from tensorflow import keras
-from tensorflow.keras.applications import imagenet_utils
 
 from src.lib.layers import decoders
 from src.lib.layouts import TensorLayout
 from src.lib.predecode import to_np_dtype
+from src.lib.predictions import PredictionDecoder, imagenet_decoder
 from src.modelconfig import ModelConfig
+from src.server.metrics import ServerMetrics
+from src.utils import split_server_model_by_config
+
+logger = logging.getLogger(__name__)
 
 
 @dataclass
 class ModelReference:
     ref_count: int
     model: keras.Model
+    num_bytes: int = 0
+    backbone: str = None
+
+
+_Evicted = List[ModelReference]
 
 
 class ModelManager:
     """Manages TensorFlow models.
 
     Holds model references, loads, releases, and runs predictions.
+    Models are loaded one at a time on a background loader thread.
+
+    With share_weights, the full model of each architecture (its
+    backbone) is loaded only once. Server-side models for each split
+    config are then built from the backbone's layers, and so share its
+    weights. A backbone remains resident as long as any model built from
+    it is resident. If the full model is unavailable, the split config's
+    own server-side model file is loaded instead.
+
+    Released models (with no remaining references) stay resident, and
+    are evicted in least recently released order once the total size of
+    resident weights exceeds memory_budget bytes. Memory of evicted
+    models is reclaimed on the loader thread, so that releasing a model
+    does not stall inference. on_evict, if given, is called with the
+    config of each evicted model.
+
+    Predictions are decoded by the prediction decoder of each model
+    (architecture) name, defaulting to ImageNet labels.
     """
 
-    def __init__(self):
+    def __init__(
+        self,
+        memory_budget: int = None,
+        share_weights: bool = True,
+        prediction_decoders: Dict[str, PredictionDecoder] = None,
+        metrics: ServerMetrics = None,
+        on_evict: Callable[[ModelConfig], None] = None,
+    ):
         self.models: Dict[ModelConfig, ModelReference] = {}
+        self.backbones: Dict[str, ModelReference] = {}
+        self.memory_budget = memory_budget
+        self.share_weights = share_weights
+        self.prediction_decoders = dict(prediction_decoders or {})
+        self.metrics = ServerMetrics() if metrics is None else metrics
+        self.on_evict = on_evict
+        self._released: OrderedDict = OrderedDict()
+        self._loading: Dict[ModelConfig, Future] = {}
+        self._waiting: Dict[ModelConfig, int] = {}
+        self._loader = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="loader"
+        )
+        self._lock = threading.RLock()
 
     def acquire(self, model_config: ModelConfig):
-        if model_config not in self.models:
-            print(f"Loading model {model_config}")
-            model = _load_model(model_config)
-            self.models[model_config] = ModelReference(0, model)
-            print(f"Loaded model {model_config}")
-        self.models[model_config].ref_count += 1
+        """Acquire model, blocking until it is loaded."""
+        self.acquire_async(model_config).result()
+
+    def acquire_async(self, model_config: ModelConfig) -> Future:
+        """Acquire model, loading it on the background loader if needed.
+
+        Concurrent acquisitions of the same model share a single load.
+
+        Returns:
+            Future that completes once the model is loaded and acquired.
+        """
+        with self._lock:
+            ref = self.models.get(model_config)
+            if ref is not None:
+                ref.ref_count += 1
+                self._released.pop(model_config, None)
+                future = Future()
+                future.set_result(None)
+                return future
+            load = self._loading.get(model_config)
+            if load is None:
+                load = self._loader.submit(self._load, model_config)
+                self._loading[model_config] = load
+                self._waiting[model_config] = 0
+            self._waiting[model_config] += 1
+
+        future = Future()
+
+        def on_loaded(load: Future):
+            exception = load.exception()
+            if exception is not None:
+                future.set_exception(exception)
+                return
+            future.set_result(None)
+
+        load.add_done_callback(on_loaded)
+        return future
+
+    def _load(self, model_config: ModelConfig):
+        """Load model, acquiring it once for each waiting acquisition."""
+        try:
+            # Load outside of lock so that other models remain usable
+            logger.info("Loading model %s", model_config)
+            t0 = time.monotonic()
+            loaded = self._load_model(model_config)
+            try:
+                _warm_up(loaded.model)
+                self.prediction_decoder(model_config)
+            except Exception:
+                if loaded.backbone is not None:
+                    self._unload_backbone(loaded.backbone)
+                raise
+            t1 = time.monotonic()
+            self.metrics.model_loaded(model_config, t1 - t0)
+            logger.info(
+                "Loaded model %s (%d B)", model_config, loaded.num_bytes
+            )
+            with self._lock:
+                loaded.ref_count = self._waiting[model_config]
+                self.models[model_config] = loaded
+                evicted = self._evict()
+        finally:
+            with self._lock:
+                del self._loading[model_config]
+                del self._waiting[model_config]
+        self._drop_evicted(evicted)
 
     def release(self, model_config: ModelConfig):
-        self.models[model_config].ref_count -= 1
-        if self.models[model_config].ref_count == 0:
-            print(f"Releasing model {model_config}")
-            # del self.models[model_config].model
-            # del self.models[model_config]
-            print(f"Released model {model_config}")
+        with self._lock:
+            ref = self.models[model_config]
+            ref.ref_count -= 1
+            if ref.ref_count != 0:
+                return
+            logger.info("Releasing model %s", model_config)
+            self._released[model_config] = None
+            evicted = self._evict()
+        del ref
+        self._drop_evicted(evicted)
+        logger.info("Released model %s", model_config)
 
-    def input_tensor_layout(self, model_config: ModelConfig) -> TensorLayout:
-        model = self.models[model_config].model
-        # Check if client-side inference
-        if model is None:
+    def preload(self, model_config: ModelConfig):
+        """Load and warm up model, leaving it resident but released."""
+        self.acquire(model_config)
+        self.release(model_config)
+
+    def memory_usage(self) -> Dict[Union[ModelConfig, str], int]:
+        """Measured size in bytes of each resident model and backbone.
+
+        Models built from a backbone are reported as zero bytes, since
+        their weights are accounted for by the backbone.
+        """
+        with self._lock:
+            refs = {**self.models, **self.backbones}
+            return {k: v.num_bytes for k, v in refs.items()}
+
+    def _total_bytes(self) -> int:
+        refs = [*self.models.values(), *self.backbones.values()]
+        return sum(x.num_bytes for x in refs)
+
+    def _evict(self) -> _Evicted:
+        """Evict least recently released models until within budget.
+
+        Models built from a backbone only free memory along with their
+        backbone, so they are evicted together with all other models
+        built from it, once none of those remain in use. Until then,
+        they are skipped.
+        """
+        evicted = []
+        if self.memory_budget is None:
+            return evicted
+        for model_config in list(self._released):
+            if self._total_bytes() <= self.memory_budget:
+                break
+            if model_config not in self._released:
+                continue
+            backbone = self.models[model_config].backbone
+            if backbone is None:
+                evicted.extend(self._evict_model(model_config))
+                continue
+            dependents = [
+                k
+                for k in self._released
+                if self.models[k].backbone == backbone
+            ]
+            # Backbone is also referenced by models in use or loading
+            if self.backbones[backbone].ref_count > len(dependents):
+                continue
+            for k in dependents:
+                evicted.extend(self._evict_model(k))
+        return evicted
+
+    def _evict_model(self, model_config: ModelConfig) -> _Evicted:
+        del self._released[model_config]
+        ref = self.models.pop(model_config)
+        logger.info("Evicting model %s (%d B)", model_config, ref.num_bytes)
+        self.metrics.model_evicted(model_config)
+        if self.on_evict is not None:
+            self.on_evict(model_config)
+        if ref.backbone is None:
+            return [ref]
+        return [ref, *self._release_backbone(ref.backbone)]
+
+    def _drop_evicted(self, evicted: _Evicted):
+        """Drop last references to evicted models on the loader thread."""
+        if len(evicted) == 0:
+            return
+        self._loader.submit(_collect, evicted)
+
+    def _acquire_backbone(self, model_name: str) -> Optional[keras.Model]:
+        with self._lock:
+            ref = self.backbones.get(model_name)
+            if ref is not None:
+                ref.ref_count += 1
+                return ref.model
+
+        if not os.path.exists(_backbone_path(model_name)):
             return None
-        input_dtype = to_np_dtype(model.layers[0].dtype)
-        # TODO why is this layer[1]?
-        input_shape = model.layers[1].input_shape[1:]
-        h, w, c = input_shape
-        return TensorLayout(input_dtype, c, h, w, "hwc")
+        logger.info("Loading backbone %s", model_name)
+        model = _load_backbone(model_name)
+
+        with self._lock:
+            loaded = ModelReference(0, model, _model_num_bytes(model))
+            ref = self.backbones.setdefault(model_name, loaded)
+            ref.ref_count += 1
+            return ref.model
+
+    def _release_backbone(self, model_name: str) -> _Evicted:
+        ref = self.backbones[model_name]
+        ref.ref_count -= 1
+        if ref.ref_count != 0:
+            return []
+        logger.info("Evicting backbone %s (%d B)", model_name, ref.num_bytes)
+        del self.backbones[model_name]
+        return [ref]
+
+    def _unload_backbone(self, model_name: str):
+        """Release backbone acquired by a model that failed to load."""
+        with self._lock:
+            evicted = self._release_backbone(model_name)
+        self._drop_evicted(evicted)
+
+    def _load_model(self, model_config: ModelConfig) -> ModelReference:
+        if self.share_weights and model_config.layer != "client":
+            backbone = self._acquire_backbone(model_config.model)
+            if backbone is not None:
+                try:
+                    model = (
+                        backbone
+                        if model_config.layer == "server"
+                        else split_server_model_by_config(
+                            backbone, model_config
+                        )
+                    )
+                except Exception:
+                    self._unload_backbone(model_config.model)
+                    raise
+                return ModelReference(0, model, 0, model_config.model)
+
+        model = _load_model(model_config)
+        return ModelReference(0, model, _model_num_bytes(model))
+
+    def input_tensor_layout(self, model_config: ModelConfig) -> TensorLayout:
+        with self._lock:
+            model = self.models[model_config].model
+        return _input_tensor_layout(model)
 
     # @synchronized
     def predict(
         self, model_config: ModelConfig, data_tensor: np.ndarray
-    ) -> List[Tuple[str, str, float]]:
-        model = self.models[model_config].model
+    ) -> np.ndarray:
+        """Run prediction on batch of tensors."""
+        with self._lock:
+            model = self.models[model_config].model
         if model is None:
             return data_tensor
         return model.predict_on_batch(data_tensor)
 
+    def prediction_decoder(
+        self, model_config: ModelConfig
+    ) -> PredictionDecoder:
+        decoder = self.prediction_decoders.get(model_config.model)
+        if decoder is None:
+            decoder = imagenet_decoder()
+        return decoder
+
     def decode_predictions(
         self,
         model_config: ModelConfig,
         predictions: np.ndarray,
         num_preds: int = 3,
-    ) -> List[Tuple[str, str, float]]:
-        return _decode_predictions_imagenet(predictions, num_preds)
+    ) -> List[List[Tuple[str, str, float]]]:
+        """Decode batch of predictions into top predictions per frame."""
+        decoder = self.prediction_decoder(model_config)
+        return decoder.decode(predictions, num_preds)
+
+    def top_predictions(
+        self,
+        model_config: ModelConfig,
+        predictions: np.ndarray,
+        num_preds: int = 3,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Class indices and scores of top predictions per frame."""
+        decoder = self.prediction_decoder(model_config)
+        return decoder.top_k(predictions, num_preds)
+
+
+def _input_tensor_layout(model: keras.Model) -> TensorLayout:
+    # Check if client-side inference
+    if model is None:
+        return None
+    input_dtype = to_np_dtype(model.layers[0].dtype)
+    # TODO why is this layer[1]?
+    input_shape = model.layers[1].input_shape[1:]
+    h, w, c = input_shape
+    return TensorLayout(input_dtype, c, h, w, "hwc")
+
+
+def _warm_up(model: keras.Model):
+    """Run dummy inference, so that the first frame skips graph tracing."""
+    tensor_layout = _input_tensor_layout(model)
+    if tensor_layout is None:
+        return
+    shape = (1, *tensor_layout.shape)
+    model.predict_on_batch(np.zeros(shape, dtype=tensor_layout.dtype))
+
 
+def _model_num_bytes(model: keras.Model) -> int:
+    if model is None:
+        return 0
+    return sum(int(np.prod(w.shape)) * w.dtype.size for w in model.weights)
 
-def _decode_predictions_imagenet(
-    predictions: np.ndarray, num_preds: int = 3
-) -> List[Tuple[str, str, float]]:
-    pred = imagenet_utils.decode_predictions(predictions)[0][:num_preds]
-    return [(name, desc, float(score)) for name, desc, score in pred]
+
+def _collect(evicted: _Evicted):
+    # Drop last references to evicted models before collecting
+    evicted.clear()
+    gc.collect()
+
+
+def _custom_objects(model_config: ModelConfig) -> Dict[str, type]:
+    decoder = model_config.decoder
+    if decoder == "None":
+        return {}
+    return {decoder: decoders[decoder]}
+
+
+def _backbone_path(model_name: str) -> str:
+    return f"models/{model_name}/{model_name}-full.h5"
+
+
+def _load_backbone(model_name: str) -> keras.Model:
+    return keras.models.load_model(
+        filepath=_backbone_path(model_name), compile=False
+    )
+
+
+def _model_path(model_config: ModelConfig) -> str:
+    if model_config.layer == "server":
+        return _backbone_path(model_config.model)
+    return f"models/{model_config.to_path()}-server.h5"
 
 
 def _load_model(model_config: ModelConfig) -> keras.Model:
-    model_name = model_config.model
     if model_config.layer == "server":
-        return keras.models.load_model(
-            filepath=f"models/{model_name}/{model_name}-full.h5",
-            compile=False,
-        )
+        return _load_backbone(model_config.model)
     if model_config.layer == "client":
         return None
-    decoder = model_config.decoder
-    custom_objects = {}
-    if decoder != "None":
-        custom_objects[decoder] = decoders[decoder]
     return keras.models.load_model(
-        filepath=f"models/{model_config.to_path()}-server.h5",
+        filepath=_model_path(model_config),
         compile=False,
-        custom_objects=custom_objects,
+        custom_objects=_custom_objects(model_config),
     )
@@ -1,37 +1,206 @@
 import asyncio
 import base64
 import json
+import logging
 import math
+import threading
 from asyncio import StreamReader, StreamWriter
+from dataclasses import dataclass
+from functools import lru_cache
 from io import BytesIO
-from typing import Awaitable, ByteString
+from typing import Awaitable, ByteString, Callable, List, Optional, Tuple
 
 import numpy as np
 from matplotlib import cm
-from matplotlib.colors import Normalize
 from PIL import Image
 
 from src.lib.layouts import TensorLayout
 from src.lib.tile import determine_tile_layout, tile
+from src.server.log import frame_logger
+from src.server.stats import FrameSample, StatsCollector, Timestamps
+
+logger = logging.getLogger(__name__)
+
+# Default minimum time (s) between updates sent to a viewer
+DEFAULT_INTERVAL = 0.2
 
 
 class MonitorStats:
+    """Statistics for monitor clients.
+
+    Holds the most recent frame, as well as rolling statistics of each
+    client and model config (see StatsCollector).
+
+    Only a reference to the most recent frame's data tensor is kept. Its
+    preview is rendered once a monitor client requests it, at most once
+    per frame, so frames cost nothing extra while no monitor is
+    connected.
+
+    Listeners are called (on the adding thread) whenever a frame is added.
+
+    Viewed events are set while any monitor is connected, so that frame
+    producers (possibly in other processes) can skip passing along data
+    tensors nobody will look at.
+    """
+
     def __init__(self):
-        self.add(-1, -1, [], b"")
+        self._lock = threading.Lock()
+        self._num_viewers = 0
+        self._viewed_events = []
+        self._render_lock = threading.Lock()
+        self._preview = (None, "")
+        self._listeners: List[Callable[[], None]] = []
+        self.frame_stats = StatsCollector()
+        self.version = 0
+        self.add(-1, -1, [], None)
+
+    def add(self, frame_number, inference_time, predictions, data_tensor):
+        with self._lock:
+            self.frame_number = frame_number
+            self.inference_time = inference_time
+            self.predictions = predictions
+            self.data_tensor = data_tensor
+            self.version += 1
+        for listener in self._listeners:
+            listener()
+
+    def record(self, samples: List[FrameSample]):
+        """Record measurements of processed frames."""
+        self.frame_stats.record(samples)
+
+    def record_stages(self, timestamps: Timestamps):
+        """Record times at which a frame reached each pipeline stage."""
+        self.frame_stats.record_stages(timestamps)
+
+    def remove_client(self, guid: int):
+        self.frame_stats.remove_client(guid)
 
-    def add(self, frame_number, inference_time, predictions, data):
-        self.frame_number = frame_number
-        self.inference_time = inference_time
-        self.predictions = predictions
-        self.data = data
+    def add_listener(self, listener: Callable[[], None]):
+        self._listeners.append(listener)
+
+    def viewed_event(self, event=None):
+        """Event (threading.Event, unless given) set while any monitor is
+        connected."""
+        event = threading.Event() if event is None else event
+        with self._lock:
+            if self._num_viewers != 0:
+                event.set()
+            self._viewed_events.append(event)
+        return event
+
+    @property
+    def viewed(self) -> bool:
+        """Whether any monitor is connected."""
+        return self._num_viewers != 0
+
+    def add_viewer(self):
+        with self._lock:
+            self._num_viewers += 1
+            for event in self._viewed_events:
+                event.set()
+
+    def remove_viewer(self):
+        with self._lock:
+            self._num_viewers -= 1
+            if self._num_viewers == 0:
+                for event in self._viewed_events:
+                    event.clear()
 
     def json_dict(self) -> dict:
-        return {
-            "frameNumber": self.frame_number,
-            "inferenceTime": self.inference_time,
-            "predictions": self.predictions,
-            "data": self.data,
+        """Retrieve statistics, rendering preview if not yet rendered."""
+        _, _, d = self.snapshot()
+        return d
+
+    def snapshot(self) -> Tuple[int, Optional[int], dict]:
+        """Retrieve statistics, with their version and preview version.
+
+        The preview version is None if there is no preview.
+        """
+        with self._render_lock:
+            with self._lock:
+                version = self.version
+                frame_number = self.frame_number
+                inference_time = self.inference_time
+                predictions = self.predictions
+                data_tensor = self.data_tensor
+            preview_version = None if data_tensor is None else version
+            prev_preview_version, data = self._preview
+            if prev_preview_version != preview_version:
+                data = ""
+                if data_tensor is not None:
+                    data = image_preview(data_tensor)
+                self._preview = (preview_version, data)
+        d = {
+            "frameNumber": frame_number,
+            "inferenceTime": inference_time,
+            "predictions": predictions,
+            "data": data,
+            **self.frame_stats.json_dict(),
         }
+        return version, preview_version, d
+
+
+@dataclass
+class MonitorUpdate:
+    version: int
+    preview_version: Optional[int]
+    # Serialized statistics, with and without preview
+    full: bytes
+    delta: bytes
+
+
+class MonitorFeed:
+    """Publishes monitor statistics to any number of viewers.
+
+    Statistics are serialized once per new frame, only while viewers are
+    waiting for it, and the serialized update is shared by all viewers.
+    Must be created on the event loop that viewers run on.
+    """
+
+    def __init__(self, monitor_stats: MonitorStats):
+        self.monitor_stats = monitor_stats
+        self._loop = asyncio.get_event_loop()
+        self._changed = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._update: MonitorUpdate = None
+        monitor_stats.add_listener(self._on_change)
+
+    async def next_update(self, version: Optional[int]) -> MonitorUpdate:
+        """Wait for statistics newer than given version."""
+        while True:
+            changed = self._changed
+            if self.monitor_stats.version != version:
+                break
+            await changed.wait()
+        async with self._lock:
+            version = self.monitor_stats.version
+            if self._update is None or self._update.version != version:
+                self._update = await self._loop.run_in_executor(
+                    None, self._serialize
+                )
+            return self._update
+
+    def _on_change(self):
+        # Viewers connecting later start from the latest version anyway
+        if self.monitor_stats.viewed:
+            self._loop.call_soon_threadsafe(self._notify)
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def _serialize(self) -> MonitorUpdate:
+        version, preview_version, d = self.monitor_stats.snapshot()
+        full = f"{json.dumps(d)}\n".encode("utf8")
+        del d["data"]
+        delta = f"{json.dumps(d)}\n".encode("utf8")
+        return MonitorUpdate(version, preview_version, full, delta)
+
+
+@dataclass
+class _Viewer:
+    # Minimum time (s) between updates
+    interval: float = DEFAULT_INTERVAL
 
 
 async def read_json(reader: StreamReader) -> Awaitable[dict]:
@@ -39,23 +208,83 @@ async def read_json(reader: StreamReader) -> Awaitable[dict]:
 
 
 def handle_client(monitor_stats: MonitorStats):
+    """Push updates to each viewer as new frames arrive.
+
+    Viewers may send JSON lines such as {"maxRate": 10} to limit their
+    update rate, where a maxRate of 0 or null lifts the limit. Preview
+    images are only sent when they change. A slow viewer only delays its
+    own updates, and skips to the latest one once it catches up.
+    """
+    monitor_feed = MonitorFeed(monitor_stats)
+
     async def client_handler(reader: StreamReader, writer: StreamWriter):
-        print("New monitor client...")
         ip, port = writer.get_extra_info("peername")
-        print(f"Connected to {ip}:{port}")
+        logger.info("Monitor connected: %s:%d", ip, port)
+        monitor_stats.add_viewer()
+        viewer = _Viewer()
+        tasks = [
+            asyncio.create_task(_read_requests(reader, viewer)),
+            asyncio.create_task(_push_updates(writer, viewer, monitor_feed)),
+        ]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+            monitor_stats.remove_viewer()
+            logger.info("Monitor disconnected: %s:%d", ip, port)
 
+    return client_handler
+
+
+async def _read_requests(reader: StreamReader, viewer: _Viewer):
+    while True:
+        line = await reader.readline()
+        if len(line) == 0:
+            return
+        try:
+            request = json.loads(line)
+            if "maxRate" in request:
+                viewer.interval = _interval(request["maxRate"])
+        except (ValueError, TypeError):
+            logger.warning("Ignoring invalid monitor request: %r", line)
+
+
+def _interval(max_rate: Optional[float]) -> float:
+    """Minimum time (s) between updates, for max rate (or 0 or None if
+    unlimited)."""
+    if max_rate is None or max_rate == 0:
+        return 0.0
+    if (
+        isinstance(max_rate, bool)
+        or not isinstance(max_rate, (int, float))
+        or not max_rate > 0
+    ):
+        raise ValueError(f"Invalid maxRate: {max_rate!r}")
+    return 1 / max_rate
+
+
+async def _push_updates(
+    writer: StreamWriter, viewer: _Viewer, monitor_feed: MonitorFeed
+):
+    version = None
+    preview_version = None
+    try:
         while True:
-            # request = await read_json(reader)
-            d = monitor_stats.json_dict()
-            response = json.dumps(d)
-            writer.write(f"{response}\n".encode("utf8"))
-            print(f"Monitor upload: {len(response)} B; {response[:50]}")
-            print()
-            # print(f"Monitor upload: {len(response) // 1000} KB")
+            update = await monitor_feed.next_update(version)
+            if update.preview_version != preview_version:
+                response = update.full
+            else:
+                response = update.delta
+            writer.write(response)
+            frame_logger.debug("Monitor upload: %d B", len(response))
             await writer.drain()
-            await asyncio.sleep(0.2)
-
-    return client_handler
+            version = update.version
+            preview_version = update.preview_version
+            await asyncio.sleep(viewer.interval)
+    except ConnectionError:
+        pass
 
 
 def image_preview(data_tensor: np.ndarray) -> ByteString:
@@ -63,9 +292,7 @@ def image_preview(data_tensor: np.ndarray) -> ByteString:
         return (x * 255.99).astype(dtype=np.uint8)
 
     def colormap(x):
-        cmap = cm.viridis
-        rgba = cmap(x)
-        return denorm(rgba[:, :, :3])
+        return _viridis_lut()[x]
 
     # Handle softmax layer
     if len(data_tensor.shape) <= 2:
@@ -83,14 +310,20 @@ def image_preview(data_tensor: np.ndarray) -> ByteString:
     if data_tensor.dtype != np.uint8:
         a = np.min(data_tensor)
         b = np.max(data_tensor)
-        arr = _tile_tensor((data_tensor - a) / (b - a))
+        arr = _tile_tensor(denorm((data_tensor - a) / ((b - a) or 1)))
         return _b64png_encode(colormap(arr))
 
-    norm = Normalize(vmin=0, vmax=255)
-    arr = norm(_tile_tensor(data_tensor))
+    arr = _tile_tensor(data_tensor)
     return _b64png_encode(colormap(arr))
 
 
+@lru_cache(maxsize=None)
+def _viridis_lut() -> np.ndarray:
+    """RGB colors of viridis colormap, indexed by uint8 value."""
+    rgba = cm.viridis(np.arange(256))
+    return (rgba[:, :3] * 255.99).astype(dtype=np.uint8)
+
+
 def _tile_tensor(data_tensor: np.ndarray) -> np.ndarray:
     data_tensor = data_tensor[0]
     tensor_layout = TensorLayout.from_tensor(data_tensor, "hwc")
@@ -0,0 +1,595 @@
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Callable, Deque, Dict, List, Set, Tuple, Union
+
+import numpy as np
+
+from src.lib.layouts import TensorLayout
+from src.lib.predecode import PredecodeBatch, Predecoder
+from src.modelconfig import ModelConfig
+from src.server.comm import (
+    binary_dropped,
+    binary_result,
+    json_dropped,
+    json_ready,
+    json_result,
+)
+from src.server.metrics import ServerMetrics
+from src.server.model_manager import ModelManager
+from src.server.monitor_client import MonitorStats
+from src.server.reader import FrameRequest
+from src.server.stats import FrameSample, Timestamps
+from src.server.work_distributor import (
+    RequestQueue,
+    SmartProcessor,
+    WorkDistributor,
+)
+from src.utils import get_predecoder
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class State:
+    model_config: ModelConfig = None
+    predecoder: Predecoder = None
+    tensor_layout: TensorLayout = None
+    result_format: str = "json"
+    timings: bool = False
+    # Model load in progress, and requests received during it
+    loading: Future = None
+    pending: Deque[Tuple[str, Any]] = field(default_factory=deque)
+
+
+@dataclass
+class Frame:
+    guid: int
+    frame_number: int
+    model_config: ModelConfig
+    data_tensor: np.ndarray
+    predecode_time: float
+    result_format: str
+    num_bytes: int
+    # Time from receipt until predecoding began
+    queue_wait: float
+    timestamps: Timestamps
+    # Whether to include timestamps in result
+    timings: bool
+    inference_time: float = None
+
+
+@dataclass
+class Batch:
+    """Predict requests of a model config, predecoded as they arrive."""
+
+    data: PredecodeBatch
+    requests: List[Tuple[int, FrameRequest]] = field(default_factory=list)
+    # Time at which each request began to be predecoded
+    start_times: List[float] = field(default_factory=list)
+
+
+# How often to check for completed model loads, while any are pending
+LOAD_POLL_INTERVAL = 0.01
+
+
+class Processor:
+    """Process work items received from a request queue.
+
+    Work items flow through three pipeline stages, each running on its
+    own thread and connected by bounded queues:
+
+        predecode: client state, model acquisition, batched predecoding
+        inference: forward passes, model release
+        response: prediction decoding, results, monitor previews
+
+    so that predecoding of the next batch and previewing of the previous
+    batch overlap with inference of the current batch. Models are loaded
+    in the background; while a client's model loads, its requests are
+    set aside (and its "ready" response delayed) without holding up
+    other clients. Only the newest max_pending_frames frames (or
+    stage_queue_size frames, if unset) are set aside; older frames are
+    dropped. Once loaded, set aside requests are looked at again like
+    newly received ones, so they may still be dropped. When a stage
+    falls behind, the bounded queues fill up and block the previous
+    stage, and eventually the request queue and socket reader.
+
+    Predict requests from all clients sharing a model config (and
+    predecoded tensor shape) are grouped into batches of up to
+    max_batch_size frames, and run as a single forward pass. A batch is
+    run once it is full, once max_batch_wait seconds have passed since
+    its first frame arrived, or before any other request type is handled
+    (so that per-client ordering is preserved). Frames are predecoded in
+    parallel as they join a batch, straight into its batch tensor. Only
+    one batch waits for inference at a time; frames beyond it stay
+    queued, where they may still join larger batches or be dropped.
+
+    For real-time streams, frames may be dropped rather than processed:
+    only the newest max_pending_frames frames of each client are kept,
+    and frames older than max_frame_age seconds are discarded, whether
+    still queued, joining a batch, or about to be run. Dropped frames
+    are answered with a "dropped" message instead of a result.
+
+    A "fence" request marks the end of a client's requests to this
+    processor, before they move elsewhere: once everything before it
+    has passed through all stages, the client's state is discarded and
+    the client resumed on the results queue.
+    """
+
+    def __init__(
+        self,
+        requests: RequestQueue,
+        results: WorkDistributor,
+        monitor_stats: MonitorStats,
+        max_batch_size: int = 1,
+        max_batch_wait: float = 0.0,
+        stage_queue_size: int = 4,
+        memory_budget: int = None,
+        share_weights: bool = True,
+        preload: List[ModelConfig] = (),
+        max_pending_frames: int = None,
+        max_frame_age: float = None,
+        metrics: ServerMetrics = None,
+        on_evict: Callable[[ModelConfig], None] = None,
+        monitor_viewed: threading.Event = None,
+    ):
+        self.results = results
+        self.monitor_stats = monitor_stats
+        self.monitor_viewed = monitor_viewed
+        self.max_batch_size = max_batch_size
+        self.max_batch_wait = max_batch_wait
+        self.max_frame_age = max_frame_age
+        self.metrics = ServerMetrics() if metrics is None else metrics
+        self.model_manager = ModelManager(
+            memory_budget=memory_budget,
+            share_weights=share_weights,
+            metrics=self.metrics,
+            on_evict=on_evict,
+        )
+        self.smart_processor = SmartProcessor(
+            requests,
+            max_lookahead=stage_queue_size,
+            max_pending=max_pending_frames,
+            max_age=max_frame_age,
+            on_drop=self._drop,
+        )
+        self.max_set_aside = (
+            stage_queue_size
+            if max_pending_frames is None
+            else max_pending_frames
+        )
+        self.states: Dict[int, State] = defaultdict(State)
+        self.loading: Set[int] = set()
+        self.batches: Dict[Tuple[ModelConfig, Tuple[int, ...]], Batch] = {}
+        self.batch_deadline: float = None
+        self.inference_q = queue.Queue(maxsize=1)
+        self.response_q = queue.Queue(maxsize=stage_queue_size)
+        self.preload = list(preload)
+
+    def run(self):
+        """Run pipeline, with the predecode stage on the calling thread."""
+        if len(self.preload) != 0:
+            thread = threading.Thread(
+                target=self._preload, name="preload", daemon=True
+            )
+            thread.start()
+        stages = {
+            "inference": self._inference_step,
+            "response": self._response_step,
+        }
+        for name, step in stages.items():
+            thread = threading.Thread(
+                target=_run_forever, args=(step,), name=name, daemon=True
+            )
+            thread.start()
+        _run_forever(self._predecode_step)
+
+    def _preload(self):
+        """Load and warm up models in the background."""
+        n = len(self.preload)
+        for i, model_config in enumerate(self.preload):
+            try:
+                self.model_manager.preload(model_config)
+                logger.info(
+                    "Preloaded model %d/%d: %s", i + 1, n, model_config
+                )
+            except Exception:
+                logger.exception("Failed to preload %s", model_config)
+        logger.info("Preloading complete (%d models)", n)
+
+    # Predecode stage
+
+    def _predecode_step(self):
+        self._resume_loaded()
+        timeout = self._batch_timeout()
+        if len(self.loading) != 0 and (
+            timeout is None or timeout > LOAD_POLL_INTERVAL
+        ):
+            timeout = LOAD_POLL_INTERVAL
+        try:
+            guid, (request_type, item) = self.smart_processor.get(timeout)
+        except queue.Empty:
+            if self._batch_timeout() == 0.0:
+                self._flush_all()
+            return
+        if request_type == "predict":
+            item.timestamps["dequeue"] = time.monotonic()
+        state = self.states[guid]
+        if state.loading is not None:
+            self._set_aside(guid, state, request_type, item)
+            return
+        self._handle_request(guid, state, request_type, item)
+
+    def _set_aside(
+        self, guid: int, state: State, request_type: str, item: Any
+    ):
+        """Set request aside until model loads, dropping oldest frame if
+        too many are set aside."""
+        state.pending.append((request_type, item))
+        if request_type != "predict":
+            return
+        frames = [
+            i for i, (x, _) in enumerate(state.pending) if x == "predict"
+        ]
+        if len(frames) <= self.max_set_aside:
+            return
+        oldest = state.pending[frames[0]]
+        del state.pending[frames[0]]
+        self._drop((guid, oldest))
+
+    def _drop(self, request: Tuple[int, Tuple[str, Any]]):
+        guid, (request_type, item) = request
+        if request_type != "predict":
+            return
+        _release(item)
+        self.metrics.frame_dropped()
+        # Client may have terminated (or moved) since
+        state = self.states.get(guid)
+        if state is None:
+            return
+        self._send_dropped(
+            guid, state.result_format, item.frame_number, len(item.data)
+        )
+
+    def _send_dropped(
+        self, guid: int, result_format: str, frame_number: int, size: int
+    ):
+        dropped = {
+            "json": json_dropped,
+            "binary": binary_dropped,
+        }[result_format]
+        self._send(guid, dropped(frame_number, size))
+
+    def _expired(self, timestamps: Timestamps) -> bool:
+        return (
+            self.max_frame_age is not None
+            and time.monotonic() - timestamps["recv"] > self.max_frame_age
+        )
+
+    def _resume_loaded(self):
+        """Handle requests set aside while models were loading."""
+        loaded = [x for x in self.loading if self.states[x].loading.done()]
+        for guid in loaded:
+            self.loading.remove(guid)
+            state = self.states[guid]
+            future, state.loading = state.loading, None
+            try:
+                future.result()
+                # TODO have client provide the tiled_layout
+                state.tensor_layout = self.model_manager.input_tensor_layout(
+                    state.model_config
+                )
+            except Exception:
+                logger.exception("Failed to load %s", state.model_config)
+                state.model_config = None
+            pending, state.pending = state.pending, deque()
+            self.smart_processor.requeue((guid, x) for x in pending)
+
+    def _handle_request(
+        self, guid: int, state: State, request_type: str, item: Any
+    ):
+        if request_type == "predict":
+            self._enqueue_batch(guid, state, item)
+            return
+
+        self._flush_all()
+
+        if request_type == "acquire":
+            model_config = item
+            assert state.model_config is None
+            state.model_config = model_config
+            state.loading = self.model_manager.acquire_async(model_config)
+            self.loading.add(guid)
+            return
+        if request_type == "init_postencoder":
+            postencoder_config = item
+            state.predecoder = get_predecoder(
+                postencoder_config, state.model_config, state.tensor_layout
+            )
+            return
+        if request_type == "init_result_format":
+            state.result_format = item
+            return
+        if request_type == "init_timings":
+            state.timings = item
+            return
+        if request_type == "release":
+            model_config = item
+            assert model_config == state.model_config
+            state.model_config = None
+        elif request_type == "ready":
+            item = state.model_config
+        elif request_type in ("fence", "terminate"):
+            del self.states[guid]
+        else:
+            raise ValueError("Unknown request type")
+
+        self.inference_q.put((guid, request_type, item))
+
+    def _batch_timeout(self) -> float:
+        if self.batch_deadline is None:
+            return None
+        return max(0.0, self.batch_deadline - time.time())
+
+    def _enqueue_batch(self, guid: int, state: State, item: FrameRequest):
+        if self._expired(item.timestamps):
+            self._drop((guid, ("predict", item)))
+            return
+        t0 = time.monotonic()
+        try:
+            key = (state.model_config, state.predecoder.shape(item.data))
+            batch = self.batches.get(key)
+            if batch is None:
+                expected = 1 + self._num_queued(state.model_config)
+                batch = Batch(
+                    PredecodeBatch(self.max_batch_size, expected=expected)
+                )
+            batch.data.add(state.predecoder, item.data)
+        except Exception:
+            logger.exception("Failed to predecode frame")
+            self._drop((guid, ("predict", item)))
+            return
+        batch.requests.append((guid, item))
+        batch.start_times.append(t0)
+        self.batches[key] = batch
+        if self.batch_deadline is None:
+            self.batch_deadline = time.time() + self.max_batch_wait
+        if len(batch.requests) >= self.max_batch_size:
+            self._flush(key)
+
+    def _num_queued(self, model_config: ModelConfig) -> int:
+        """Number of frames for model config waiting in lookahead buffer."""
+        return sum(
+            request_type == "predict"
+            and guid in self.states
+            and self.states[guid].model_config == model_config
+            for guid, (request_type, _) in self.smart_processor.buffer
+        )
+
+    def _flush_all(self):
+        for key in list(self.batches):
+            self._flush(key)
+        self.batch_deadline = None
+
+    def _flush(self, key: Tuple[ModelConfig, Tuple[int, ...]]):
+        model_config, _ = key
+        batch = self.batches.pop(key)
+        if len(self.batches) == 0:
+            self.batch_deadline = None
+        errors = batch.data.errors()
+        for i, error in errors.items():
+            guid, item = batch.requests[i]
+            logger.error("Failed to predecode frame", exc_info=error)
+            self._drop((guid, ("predict", item)))
+        data_tensor, predecode_times = batch.data.result()
+        t1 = time.monotonic()
+        requests = [
+            (*x, t0)
+            for i, (x, t0) in enumerate(zip(batch.requests, batch.start_times))
+            if i not in errors
+        ]
+        # Frames may have gone stale while the batch filled up
+        expired = [
+            i
+            for i, (guid, item, _) in enumerate(requests)
+            if self._expired(item.timestamps)
+        ]
+        for i in expired:
+            guid, item, _ = requests[i]
+            self._drop((guid, ("predict", item)))
+        if len(expired) != 0:
+            data_tensor = np.delete(data_tensor, expired, axis=0)
+            requests = [x for i, x in enumerate(requests) if i not in expired]
+            predecode_times = [
+                x for i, x in enumerate(predecode_times) if i not in expired
+            ]
+        if len(requests) == 0:
+            return
+        frames = []
+        for i, (guid, item, t0) in enumerate(requests):
+            state = self.states[guid]
+            item.timestamps["predecode"] = t1
+            frame = Frame(
+                guid,
+                item.frame_number,
+                model_config,
+                data_tensor[i],
+                predecode_times[i],
+                state.result_format,
+                len(item.data),
+                t0 - item.timestamps["recv"],
+                item.timestamps,
+                state.timings,
+            )
+            frames.append(frame)
+            # Received buffer is no longer needed once copied into batch
+            _release(item)
+        self.inference_q.put((None, "predict", (frames, data_tensor)))
+
+    # Inference stage
+
+    def _inference_step(self):
+        guid, request_type, item = self.inference_q.get()
+
+        if request_type == "predict":
+            frames, data_tensor = item
+            self._infer(frames, data_tensor)
+            return
+
+        if request_type == "release":
+            model_config = item
+            self.model_manager.release(model_config)
+            return
+
+        self.response_q.put((guid, request_type, item))
+
+    def _infer(self, frames: List[Frame], data_tensor: np.ndarray):
+        # Frames may have gone stale while waiting for the inference stage
+        expired = [
+            i for i, x in enumerate(frames) if self._expired(x.timestamps)
+        ]
+        for i in expired:
+            frame = frames[i]
+            self.metrics.frame_dropped()
+            self._send_dropped(
+                frame.guid,
+                frame.result_format,
+                frame.frame_number,
+                frame.num_bytes,
+            )
+        if len(expired) == len(frames):
+            return
+        if len(expired) != 0:
+            data_tensor = np.delete(data_tensor, expired, axis=0)
+            frames = [x for i, x in enumerate(frames) if i not in expired]
+        model_config = frames[0].model_config
+        t0 = time.monotonic()
+        preds = self.model_manager.predict(model_config, data_tensor)
+        t1 = time.monotonic()
+        for frame in frames:
+            frame.inference_time = t1 - t0
+            frame.timestamps["inference"] = t1
+        self.metrics.inferred(model_config, t1 - t0, len(frames))
+        self.response_q.put((None, "result", (frames, preds)))
+
+    # Response stage
+
+    def _response_step(self):
+        guid, request_type, item = self.response_q.get()
+
+        if request_type == "result":
+            frames, preds = item
+            self._respond(frames, preds)
+        elif request_type == "ready":
+            model_config = item
+            self._send(guid, json_ready(model_config=model_config))
+        elif request_type == "terminate":
+            self.monitor_stats.remove_client(guid)
+            self.results.put(guid, None)
+        elif request_type == "fence":
+            self.results.resume(guid)
+        else:
+            raise ValueError("Unknown request type")
+
+    def _respond(self, frames: List[Frame], preds: np.ndarray):
+        model_config = frames[0].model_config
+        decoder = self.model_manager.prediction_decoder(model_config)
+        indices, scores = decoder.top_k(preds)
+        decoded = decoder.label(indices, scores)
+        decode_time = time.monotonic()
+
+        for i, frame in enumerate(frames):
+            frame.timestamps["decode"] = decode_time
+            t = frame.predecode_time + frame.inference_time
+            inference_time = int(1000 * t)
+            if frame.result_format == "binary":
+                result = binary_result(
+                    frame_number=frame.frame_number,
+                    inference_time=inference_time,
+                    indices=indices[i],
+                    scores=scores[i],
+                )
+            else:
+                result = json_result(
+                    frame_number=frame.frame_number,
+                    inference_time=inference_time,
+                    predictions=decoded[i],
+                    timings=(
+                        _relative_ms(frame.timestamps)
+                        if frame.timings
+                        else None
+                    ),
+                )
+            self._send(frame.guid, result, frame.timestamps)
+
+        now = time.time()
+        self.monitor_stats.record(
+            [
+                FrameSample(
+                    guid=x.guid,
+                    model_config=x.model_config,
+                    time=now,
+                    inference_time=x.inference_time,
+                    predecode_time=x.predecode_time,
+                    queue_wait=x.queue_wait,
+                    num_bytes=x.num_bytes,
+                )
+                for x in frames
+            ]
+        )
+
+        # Monitor only displays the most recent frame, and its data tensor
+        # is only passed along while a monitor is connected. It is copied
+        # out of the batch tensor, so as not to hold on to the whole batch.
+        frame = frames[-1]
+        viewed = self.monitor_viewed is None or self.monitor_viewed.is_set()
+        data_tensor = frame.data_tensor[np.newaxis].copy() if viewed else None
+        self.monitor_stats.add(
+            frame_number=frame.frame_number,
+            # data_shape=..., # TODO different shapes for data?
+            inference_time=inference_time,
+            predictions=decoded[-1],
+            data_tensor=data_tensor,
+        )
+
+    def _send(
+        self,
+        guid: int,
+        msg: Union[str, bytes],
+        timestamps: Timestamps = None,
+    ):
+        """Send JSON message (newline-terminated) or binary message.
+
+        Timestamps of a result are passed along, so that its write to the
+        socket can be timed too.
+        """
+        if isinstance(msg, str):
+            msg = f"{msg}\n".encode("utf8")
+        if timestamps is None:
+            self.results.put(guid, msg)
+            return
+        timestamps["result"] = time.monotonic()
+        self.results.put(guid, (msg, timestamps))
+
+
+def _relative_ms(timestamps: Timestamps) -> Dict[str, float]:
+    t0 = timestamps["read"]
+    return {k: 1000 * (v - t0) for k, v in timestamps.items()}
+
+
+def _release(item: FrameRequest):
+    """Return buffer of predict request to its pool."""
+    if item.release is not None:
+        item.release()
+
+
+def _run_forever(step: Callable[[], None]):
+    while True:
+        try:
+            step()
+        except Exception:
+            logger.exception("Unhandled error")
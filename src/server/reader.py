@@ -1,6 +1,22 @@
 import json
+import time
 from asyncio import StreamReader
-from typing import Any, Awaitable, ByteString, Tuple
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Any, Awaitable, ByteString, Callable, Tuple
+
+from src.server.stats import Timestamps
+from src.server.stream import BufferPool
+
+
+@dataclass
+class FrameRequest:
+    frame_number: int
+    data: ByteString
+    # Returns pooled data buffer for reuse
+    release: Callable[[], None] = None
+    # Time at which frame reached each pipeline stage (see STAGES)
+    timestamps: Timestamps = field(default_factory=dict)
 
 
 async def read_int(reader: StreamReader) -> Awaitable[int]:
@@ -8,12 +24,24 @@ async def read_int(reader: StreamReader) -> Awaitable[int]:
 
 
 async def read_tensor_frame(
-    reader: StreamReader,
-) -> Awaitable[Tuple[int, ByteString]]:
+    reader: StreamReader, buffer_pool: BufferPool = None
+) -> Awaitable[FrameRequest]:
+    """Read frame, directly into a pooled buffer if possible.
+
+    Pooled buffers should be released once processed.
+    """
     frame_number = await read_int(reader)
     data_len = await read_int(reader)
-    data = await reader.readexactly(data_len)
-    return frame_number, data
+    timestamps = {"read": time.monotonic()}
+    if buffer_pool is None or not hasattr(reader, "readinto"):
+        data = await reader.readexactly(data_len)
+        release = None
+    else:
+        data = buffer_pool.acquire(data_len)
+        await reader.readinto(data)
+        release = partial(buffer_pool.release, data)
+    timestamps["recv"] = time.monotonic()
+    return FrameRequest(frame_number, data, release, timestamps)
 
 
 async def read_json(reader: StreamReader) -> Awaitable[dict]:
@@ -26,14 +54,16 @@ async def read_ping(reader: StreamReader) -> Awaitable:
 
 
 # TODO form protocol on json and binary data
-async def read_item(reader: StreamReader) -> Awaitable[Tuple[str, Any]]:
+async def read_item(
+    reader: StreamReader, buffer_pool: BufferPool = None
+) -> Awaitable[Tuple[str, Any]]:
     """Retrieve single item of various types from stream."""
     input_type = (await reader.readline()).decode("utf8").rstrip("\n")
-    print(input_type)
     if len(input_type) == 0:
         return "terminate", None
+    if input_type == "frame":
+        return input_type, await read_tensor_frame(reader, buffer_pool)
     reader_func = {
-        "frame": read_tensor_frame,
         "json": read_json,
         "ping": read_ping,
     }[input_type]
@@ -0,0 +1,173 @@
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Hashable, List
+
+import numpy as np
+
+from src.modelconfig import ModelConfig
+
+# Pipeline stages of each frame, in order. Frames carry a time.monotonic()
+# timestamp of when they reached each stage.
+STAGES = (
+    "read",  # frame header read from socket
+    "recv",  # frame data received
+    "enqueue",  # pushed to request queue
+    "dequeue",  # retrieved by predecode stage
+    "predecode",  # predecoded
+    "inference",  # batch inference complete
+    "decode",  # predictions decoded
+    "result",  # result pushed to result queue
+    "written",  # result written to socket and drained
+)
+
+Timestamps = Dict[str, float]
+
+
+@dataclass
+class FrameSample:
+    """Measurements (in seconds and bytes) of a processed frame."""
+
+    guid: int
+    model_config: ModelConfig
+    time: float
+    inference_time: float
+    predecode_time: float
+    queue_wait: float
+    num_bytes: int
+
+
+# Columns of ring buffer rows
+_TIME, _INFERENCE, _PREDECODE, _QUEUE_WAIT, _BYTES = range(5)
+
+
+class RingBuffer:
+    """Fixed-capacity buffer holding the most recent rows."""
+
+    def __init__(self, capacity: int, num_columns: int):
+        self._rows = np.zeros((capacity, num_columns))
+        self._count = 0
+
+    def append(self, row: List[float]):
+        self._rows[self._count % len(self._rows)] = row
+        self._count += 1
+
+    def rows(self) -> np.ndarray:
+        """Buffered rows, in no particular order."""
+        return self._rows[: min(self._count, len(self._rows))]
+
+
+class RollingStats:
+    """Statistics over the most recent frames, within a time window."""
+
+    def __init__(self, capacity: int = 256, window: float = 10.0):
+        self.window = window
+        self._buffer = RingBuffer(capacity, 5)
+
+    def add(self, sample: FrameSample):
+        self._buffer.append(
+            [
+                sample.time,
+                sample.inference_time,
+                sample.predecode_time,
+                sample.queue_wait,
+                sample.num_bytes,
+            ]
+        )
+
+    def summary(self, now: float) -> dict:
+        """Frame rate, time percentiles (ms) and mean bytes per frame."""
+        rows = self._buffer.rows()
+        rows = rows[rows[:, _TIME] >= now - self.window]
+        if len(rows) == 0:
+            return {"fps": 0.0, "numFrames": 0}
+        times = rows[:, _TIME]
+        span = times.max() - times.min()
+        fps = 0.0 if span == 0 else (len(rows) - 1) / span
+        return {
+            "fps": fps,
+            "numFrames": len(rows),
+            "inferenceTime": _percentiles(rows[:, _INFERENCE]),
+            "predecodeTime": _percentiles(rows[:, _PREDECODE]),
+            "queueWait": _percentiles(rows[:, _QUEUE_WAIT]),
+            "bytesPerFrame": float(rows[:, _BYTES].mean()),
+        }
+
+
+class StageStats:
+    """Time spent reaching each stage from the previous, over the most
+    recent frames."""
+
+    def __init__(self, capacity: int = 256):
+        self._buffer = RingBuffer(capacity, len(STAGES) - 1)
+
+    def add(self, timestamps: Timestamps):
+        if any(x not in timestamps for x in STAGES):
+            return
+        self._buffer.append(np.diff([timestamps[x] for x in STAGES]))
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Time percentiles (ms) of each stage."""
+        rows = self._buffer.rows()
+        if len(rows) == 0:
+            return {}
+        return {
+            x: _percentiles(rows[:, i]) for i, x in enumerate(STAGES[1:])
+        }
+
+
+class StatsCollector:
+    """Rolling statistics of each client and of each model config, and
+    of pipeline stages across all frames.
+
+    Memory per client and per model config is constant. Statistics of a
+    client are dropped once it disconnects.
+    """
+
+    def __init__(self, capacity: int = 256, window: float = 10.0):
+        self.capacity = capacity
+        self.window = window
+        self._clients: Dict[int, RollingStats] = {}
+        self._models: Dict[ModelConfig, RollingStats] = {}
+        self._stages = StageStats(capacity)
+        self._lock = threading.Lock()
+
+    def record(self, samples: List[FrameSample]):
+        with self._lock:
+            for sample in samples:
+                self._stats(self._clients, sample.guid).add(sample)
+                self._stats(self._models, sample.model_config).add(sample)
+
+    def record_stages(self, timestamps: Timestamps):
+        with self._lock:
+            self._stages.add(timestamps)
+
+    def remove_client(self, guid: int):
+        with self._lock:
+            self._clients.pop(guid, None)
+
+    def json_dict(self) -> dict:
+        now = time.time()
+        with self._lock:
+            return {
+                "clients": {
+                    str(k): v.summary(now) for k, v in self._clients.items()
+                },
+                "models": {
+                    k.to_path(): v.summary(now)
+                    for k, v in self._models.items()
+                },
+                "stages": self._stages.summary(),
+            }
+
+    def _stats(self, d: Dict[Hashable, RollingStats], key) -> RollingStats:
+        stats = d.get(key)
+        if stats is None:
+            stats = RollingStats(self.capacity, self.window)
+            d[key] = stats
+        return stats
+
+
+def _percentiles(x: np.ndarray) -> Dict[str, float]:
+    p50, p95, p99 = np.percentile(x, [50, 95, 99]) * 1000
+    return {"p50": p50, "p95": p95, "p99": p99}
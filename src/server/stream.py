@@ -0,0 +1,207 @@
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable, Deque, Optional
+
+ConnectionHandler = Callable[["BufferedStream", "BufferedStream"], Awaitable]
+
+
+class BufferPool:
+    """Pool of reusable byte buffers.
+
+    Buffers may be released from any thread.
+    """
+
+    def __init__(self, max_buffers: int = 8):
+        self._free: Deque[bytearray] = deque(maxlen=max_buffers)
+
+    def acquire(self, size: int) -> memoryview:
+        """Retrieve writable buffer of given size."""
+        try:
+            buf = self._free.pop()
+        except IndexError:
+            buf = bytearray(size)
+        if len(buf) < size:
+            buf = bytearray(size)
+        return memoryview(buf)[:size]
+
+    def release(self, view: memoryview):
+        """Return buffer to pool. Its contents may be overwritten."""
+        self._free.append(view.obj)
+
+
+class BufferedStream(asyncio.BufferedProtocol):
+    """Socket stream that reads directly into caller-provided buffers.
+
+    Lines and small reads are served from an internal buffer, but
+    readinto() lets the transport write payload bytes straight into the
+    destination buffer, without intermediate allocations or copies.
+
+    Also implements the subset of the StreamWriter interface used by the
+    server (write, drain, close, get_extra_info).
+    """
+
+    def __init__(self, handler: ConnectionHandler, limit: int = 2 ** 16):
+        self._handler = handler
+        self._limit = limit
+        self._buf = bytearray(limit)
+        self._start = 0
+        self._end = 0
+        self._target: Optional[memoryview] = None
+        self._target_pos = 0
+        self._waiter: Optional[asyncio.Future] = None
+        self._eof = False
+        self._paused = False
+        self._drain_waiter: Optional[asyncio.Future] = None
+        self._write_paused = False
+        self.transport: asyncio.Transport = None
+
+    # Protocol callbacks
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        asyncio.get_event_loop().create_task(self._handler(self, self))
+
+    def connection_lost(self, exc: Optional[Exception]):
+        self._eof = True
+        self._wakeup()
+        if self._drain_waiter is not None and not self._drain_waiter.done():
+            self._drain_waiter.set_result(None)
+
+    def eof_received(self) -> bool:
+        self._eof = True
+        self._wakeup()
+        # Keep transport open, so that pending results can still be written
+        return True
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        if self._target is not None:
+            return self._target[self._target_pos :]
+        if self._start == self._end:
+            self._start = self._end = 0
+        if self._end == len(self._buf):
+            # Compact, or grow if there is nothing to compact
+            if self._start != 0:
+                n = self._end - self._start
+                self._buf[:n] = self._buf[self._start : self._end]
+                self._start, self._end = 0, n
+            else:
+                self._buf.extend(bytearray(len(self._buf)))
+        return memoryview(self._buf)[self._end :]
+
+    def buffer_updated(self, nbytes: int):
+        if self._target is not None:
+            self._target_pos += nbytes
+            if self._target_pos == len(self._target):
+                self._wakeup()
+            return
+        self._end += nbytes
+        if self._end - self._start >= self._limit and not self._paused:
+            self._paused = True
+            self.transport.pause_reading()
+        self._wakeup()
+
+    def pause_writing(self):
+        self._write_paused = True
+
+    def resume_writing(self):
+        self._write_paused = False
+        if self._drain_waiter is not None and not self._drain_waiter.done():
+            self._drain_waiter.set_result(None)
+
+    # Reading
+
+    async def readline(self) -> bytes:
+        """Read up to and including newline, or b"" at EOF."""
+        while True:
+            idx = self._buf.find(b"\n", self._start, self._end)
+            if idx != -1:
+                return self._consume(idx + 1 - self._start)
+            if self._eof:
+                return self._consume(self._end - self._start)
+            await self._wait()
+
+    async def readexactly(self, n: int) -> bytes:
+        while self._end - self._start < n:
+            if self._eof:
+                partial = self._consume(self._end - self._start)
+                raise asyncio.IncompleteReadError(partial, n)
+            await self._wait()
+        return self._consume(n)
+
+    async def readinto(self, view: memoryview):
+        """Fill given buffer entirely."""
+        n = min(len(view), self._end - self._start)
+        view[:n] = self._buf[self._start : self._start + n]
+        self._consume_into(n)
+        if n == len(view):
+            return
+        self._target = view
+        self._target_pos = n
+        try:
+            while self._target_pos < len(view):
+                if self._eof:
+                    raise asyncio.IncompleteReadError(
+                        bytes(view[: self._target_pos]), len(view)
+                    )
+                await self._wait()
+        finally:
+            self._target = None
+
+    def _consume(self, n: int) -> bytes:
+        data = bytes(self._buf[self._start : self._start + n])
+        self._consume_into(n)
+        return data
+
+    def _consume_into(self, n: int):
+        self._start += n
+        if self._paused and self._end - self._start < self._limit:
+            self._paused = False
+            self.transport.resume_reading()
+
+    async def _wait(self):
+        self._waiter = asyncio.get_event_loop().create_future()
+        if self._paused:
+            self._paused = False
+            self.transport.resume_reading()
+        try:
+            await self._waiter
+        finally:
+            self._waiter = None
+
+    def _wakeup(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    # Writing
+
+    def write(self, data: bytes):
+        self.transport.write(data)
+
+    async def drain(self):
+        if self.transport.is_closing():
+            # Let connection_lost propagate before further writes
+            await asyncio.sleep(0)
+            return
+        if not self._write_paused:
+            return
+        self._drain_waiter = asyncio.get_event_loop().create_future()
+        try:
+            await self._drain_waiter
+        finally:
+            self._drain_waiter = None
+
+    def close(self):
+        self.transport.close()
+
+    def get_extra_info(self, name: str, default=None):
+        return self.transport.get_extra_info(name, default)
+
+
+async def start_server(
+    handler: ConnectionHandler, host: str, port: int
+) -> asyncio.AbstractServer:
+    """Start server, calling handler(reader, writer) for each client."""
+    loop = asyncio.get_event_loop()
+    return await loop.create_server(
+        lambda: BufferedStream(handler), host, port
+    )
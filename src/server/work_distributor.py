@@ -1,6 +1,22 @@
+import asyncio
 import queue
+import threading
+import time
+from collections import Counter, deque
+from dataclasses import dataclass, field
 from itertools import count
-from typing import Awaitable, Dict, Generator, Generic, Tuple, TypeVar
+from typing import (
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Generator,
+    Generic,
+    Iterable,
+    Optional,
+    Tuple,
+    TypeVar,
+)
 
 import janus
 
@@ -8,23 +24,110 @@ R = TypeVar("R")
 T = TypeVar("T")
 
 
-class WorkDistributor(Generic[T, R]):
+class RequestQueue(Generic[T]):
+    """Synchronous queue of (guid, request) items awaiting processing."""
+
+    def __init__(self, q=None):
+        self._q = queue.Queue() if q is None else q
+
+    def get(self, timeout: float = None) -> Tuple[int, T]:
+        """Synchronously retrieve request for processing.
+
+        Raises queue.Empty if no request arrives within timeout seconds.
+        """
+        return self._q.get(timeout=timeout)
+
+    def get_many(
+        self, min_items=1, max_items=None, timeout: float = None
+    ) -> Generator[Tuple[int, T], None, None]:
+        """Synchronously retrieve requests for processing.
+
+        Retrieve at least min_items, blocking if necessary. Retreive up
+        to max_items if possible without blocking.
+        """
+        for _ in range(min_items):
+            yield self.get(timeout=timeout)
+        it = count() if max_items is None else range(max_items - min_items)
+        for _ in it:
+            if self.empty():
+                break
+            yield self.get()
+
+    def empty(self) -> bool:
+        """Check if process queue is empty."""
+        return self._q.empty()
+
+    def put_request(self, guid: int, item: T):
+        """Synchronously push request for processing."""
+        self._q.put((guid, item))
+
+
+@dataclass
+class _Client(Generic[T]):
+    """Scheduling state of a registered client."""
+
+    pending: Deque[T]
+    # Limits pending requests, if bounded
+    space: Optional[asyncio.Semaphore]
+    loop: asyncio.AbstractEventLoop
+    priority: float = 1.0
+    max_rate: Optional[float] = None
+    # Whether scheduling is suspended until resumed
+    held: bool = False
+    deficit: float = 0.0
+    tokens: float = 1.0
+    refill_time: float = field(default_factory=time.time)
+
+    def refill(self, now: float):
+        if self.max_rate is not None:
+            dt = now - self.refill_time
+            self.tokens = min(1.0, self.tokens + dt * self.max_rate)
+        self.refill_time = now
+
+    def wait_time(self) -> float:
+        """Time until next frame may be scheduled, or 0 if it may now."""
+        request_type, _ = self.pending[0]
+        if self.max_rate is None or request_type != "predict":
+            return 0.0
+        return max(0.0, (1.0 - self.tokens) / self.max_rate)
+
+
+class WorkDistributor(RequestQueue[T], Generic[T, R]):
     """Process async items synchronously.
 
     Queues asynchronous requests for synchronous processing. Once
     processor is ready, it reads item from request queue, then puts the
     result into the result queue.
+
+    Each client has its own request queue of up to maxsize frames, so
+    a bursting client only blocks itself. Clients are served in deficit
+    round-robin order, receiving a share of frames proportional to their
+    priority. A client's frames may also be capped to max_rate per
+    second.
+
+    Control requests (anything other than frames) take a high-priority
+    lane: they never wait for queue space, and a client whose next
+    request is a control request is served ahead of other clients'
+    frames, without counting against its share. Each client's requests
+    are still served in order.
+
+    Several consumers may retrieve requests concurrently, each limited
+    to the clients it is eligible to serve. A client may be held, so
+    that none of its requests are served until it is resumed.
     """
 
-    _requests: janus.Queue
     _results: Dict[int, janus.Queue]
 
-    def __init__(self):
+    def __init__(self, maxsize: int = 0):
         self._guid = 0
-        self._requests = janus.Queue()
+        self._maxsize = maxsize
+        self._clients: Dict[int, _Client] = {}
+        # Round-robin order of registered clients
+        self._order: Deque[int] = deque()
+        self._cond = threading.Condition()
         self._results = {}
 
-    def register(self):
+    def register(self, priority: float = 1.0, max_rate: float = None):
         """Register client for processing.
 
         Returns:
@@ -34,68 +137,261 @@ class WorkDistributor(Generic[T, R]):
         guid = self._guid
         self._guid += 1
         self._results[guid] = janus.Queue()
+        space = (
+            None if self._maxsize <= 0 else asyncio.Semaphore(self._maxsize)
+        )
+        client = _Client(deque(), space, asyncio.get_event_loop())
+        with self._cond:
+            self._clients[guid] = client
+            self._order.append(guid)
+            self._configure(client, priority, max_rate)
 
         async def put_request(item: T):
-            await self._requests.async_q.put((guid, item))
+            request_type, _ = item
+            if client.space is not None and request_type == "predict":
+                await client.space.acquire()
+            with self._cond:
+                client.pending.append(item)
+                self._cond.notify_all()
 
         async def get_result() -> Awaitable[R]:
             return await self._results[guid].async_q.get()
 
         return put_request, get_result
 
-    def get(self) -> Tuple[int, T]:
-        """Synchronously retrieve request for processing."""
-        return self._requests.sync_q.get()
+    def configure(self, guid: int, priority: float, max_rate: float = None):
+        """Change scheduling priority and frame rate cap of client."""
+        with self._cond:
+            self._configure(self._clients[guid], priority, max_rate)
+            self._cond.notify_all()
 
-    def get_many(
-        self, min_items=1, max_items=None
-    ) -> Generator[Tuple[int, T], None, None]:
-        """Synchronously retrieve requests for processing.
+    def queue_depths(self) -> Dict[int, int]:
+        """Number of pending requests of each client."""
+        with self._cond:
+            return {k: len(v.pending) for k, v in self._clients.items()}
 
-        Retrieve at least min_items, blocking if necessary. Retreive up
-        to max_items if possible without blocking.
+    def get(
+        self,
+        timeout: float = None,
+        eligible: Callable[[int], bool] = None,
+    ) -> Tuple[int, T]:
+        """Synchronously retrieve request for processing.
+
+        Only requests of clients for which eligible(guid) holds are
+        retrieved, if given.
+
+        Raises queue.Empty if no request is schedulable within timeout
+        seconds.
         """
-        for _ in range(min_items):
-            yield self.get()
-        it = count() if max_items is None else range(max_items - min_items)
-        for _ in it:
-            if self._requests.sync_q.empty():
-                break
-            yield self.get()
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while True:
+                now = time.time()
+                guid, wait = self._schedule(now, eligible)
+                if guid is not None:
+                    return guid, self._pop(guid)
+                if deadline is not None:
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        raise queue.Empty
+                    wait = remaining if wait is None else min(wait, remaining)
+                self._cond.wait(wait)
 
     def empty(self) -> bool:
-        """Check if process queue is empty."""
-        return self._requests.sync_q.empty()
+        with self._cond:
+            return all(len(x.pending) == 0 for x in self._clients.values())
+
+    def put_request(self, guid: int, item: T):
+        """Synchronously push request for processing.
+
+        Unlike the asynchronous request callback, this ignores maxsize.
+        """
+        with self._cond:
+            self._clients[guid].pending.append(item)
+            self._cond.notify_all()
+
+    def hold(self, guid: int, item: T):
+        """Return retrieved request to the front of its client's queue,
+        and stop serving the client until it is resumed."""
+        with self._cond:
+            client = self._clients[guid]
+            client.pending.appendleft(item)
+            client.held = True
+
+    def resume(self, guid: int):
+        """Resume serving a held client."""
+        with self._cond:
+            self._clients[guid].held = False
+            self._cond.notify_all()
 
     def put(self, guid: int, item: R):
         """Synchronously push processed result."""
         self._results[guid].sync_q.put(item)
 
+    def _configure(
+        self, client: _Client, priority: float, max_rate: Optional[float]
+    ):
+        if priority <= 0:
+            raise ValueError("Priority must be positive")
+        client.priority = priority
+        client.max_rate = max_rate
+
+    def _schedule(
+        self, now: float, eligible: Callable[[int], bool] = None
+    ) -> Tuple[Optional[int], Optional[float]]:
+        """Select next client to serve, by deficit round-robin.
+
+        Held clients, and clients not eligible to be served, are skipped.
+
+        Returns:
+            guid: Selected client, or None if no client is schedulable.
+            wait: Time until a rate-capped client becomes schedulable.
+        """
+        waits = []
+        schedulable = set()
+        control = set()
+        for guid, client in self._clients.items():
+            if client.held or (eligible is not None and not eligible(guid)):
+                continue
+            if len(client.pending) == 0:
+                client.deficit = 0.0
+                continue
+            request_type, _ = client.pending[0]
+            if request_type != "predict":
+                control.add(guid)
+                continue
+            client.refill(now)
+            wait = client.wait_time()
+            if wait == 0.0:
+                schedulable.add(guid)
+            else:
+                waits.append(wait)
+        if len(control) != 0:
+            return next(x for x in self._order if x in control), None
+        if len(schedulable) == 0:
+            return None, min(waits, default=None)
+        while True:
+            guid = self._order[0]
+            client = self._clients[guid]
+            if guid in schedulable and client.deficit >= 1.0:
+                client.deficit -= 1.0
+                return guid, None
+            if guid in schedulable:
+                client.deficit += client.priority
+            self._order.rotate(-1)
+
+    def _pop(self, guid: int) -> T:
+        client = self._clients[guid]
+        item = client.pending.popleft()
+        request_type, _ = item
+        if request_type == "predict" and client.max_rate is not None:
+            client.tokens -= 1.0
+        if request_type == "predict" and client.space is not None:
+            client.loop.call_soon_threadsafe(client.space.release)
+        if request_type == "terminate":
+            del self._clients[guid]
+            self._order.remove(guid)
+        return item
+
+
+class SmartProcessor(Generic[T]):
+    """Looks ahead to determine if work items should be cancelled.
 
-class SmartProcessor(Generic[T, R]):
-    """Looks ahead to determine if work items should be cancelled."""
+    A client's pending predict requests are cancelled once it releases
+    its model. For real-time streams, only the newest max_pending
+    predict requests of each client are kept, and predict requests
+    received more than max_age seconds ago are cancelled, so that
+    latency remains bounded instead of a backlog building up.
 
-    def __init__(self, work_distributor: WorkDistributor[T, R]):
+    At most max_lookahead items are buffered, so that a bounded request
+    queue still exerts backpressure on its producers. Cancelled items are
+    passed to on_drop, if given.
+    """
+
+    def __init__(
+        self,
+        work_distributor: RequestQueue[T],
+        max_lookahead: int = None,
+        max_pending: int = None,
+        max_age: float = None,
+        on_drop: Callable[[Tuple[int, T]], None] = None,
+    ):
         self.work_distributor = work_distributor
-        self.buffer = queue.Queue()
-
-    def get(self) -> Tuple[int, T]:
-        self._refresh_buffer()
-        return self.buffer.get()
-
-    def _refresh_buffer(self):
-        min_items = 1 if self.buffer.empty() else 0
-        items = list(self.work_distributor.get_many(min_items=min_items))
-        idxs = (
-            len(items) - i - 1
-            for i, (_, (request_type, _)) in enumerate(reversed(items))
-            if request_type == "release"
+        self.max_lookahead = max_lookahead
+        self.max_pending = max_pending
+        self.max_age = max_age
+        self.on_drop = on_drop
+        self.buffer: Deque[Tuple[int, T]] = deque()
+
+    def get(self, timeout: float = None) -> Tuple[int, T]:
+        """Retrieve next request.
+
+        Raises queue.Empty if no request arrives within timeout seconds.
+        """
+        while True:
+            self._refresh_buffer(timeout)
+            if len(self.buffer) == 0:
+                continue
+            x = self.buffer.popleft()
+            if self._expired(x):
+                self._drop(x)
+                continue
+            return x
+
+    def requeue(self, items: Iterable[Tuple[int, T]]):
+        """Return retrieved items to the front of the buffer, in order.
+
+        They are then subject to cancellation like newly received items.
+        """
+        self.buffer.extendleft(reversed(list(items)))
+        self._cancel_stale()
+
+    def _refresh_buffer(self, timeout: float = None):
+        min_items = 1 if len(self.buffer) == 0 else 0
+        max_items = (
+            None
+            if self.max_lookahead is None
+            else max(min_items, self.max_lookahead - len(self.buffer))
         )
-        idx = next(idxs, None)
-        if idx is None:
-            for x in items:
-                self.buffer.put(x)
+        items = list(
+            self.work_distributor.get_many(
+                min_items=min_items, max_items=max_items, timeout=timeout
+            )
+        )
+        if len(items) == 0:
             return
-        self.buffer = queue.Queue()
-        for x in items[idx:]:
-            self.buffer.put(x)
+        self.buffer.extend(items)
+        self._cancel_stale()
+
+    def _cancel_stale(self):
+        """Cancel predict requests superseded by newer requests."""
+        released = set()
+        num_pending = Counter()
+        kept = deque()
+        dropped = []
+        for x in reversed(self.buffer):
+            guid, (request_type, _) = x
+            if request_type == "release":
+                released.add(guid)
+            elif request_type == "predict":
+                num_pending[guid] += 1
+                if guid in released or (
+                    self.max_pending is not None
+                    and num_pending[guid] > self.max_pending
+                ):
+                    dropped.append(x)
+                    continue
+            kept.appendleft(x)
+        self.buffer = kept
+        for x in reversed(dropped):
+            self._drop(x)
+
+    def _expired(self, x: Tuple[int, T]) -> bool:
+        _, (request_type, item) = x
+        if self.max_age is None or request_type != "predict":
+            return False
+        return time.monotonic() - item.timestamps["recv"] > self.max_age
+
+    def _drop(self, x: Tuple[int, T]):
+        if self.on_drop is not None:
+            self.on_drop(x)
@@ -0,0 +1,338 @@
+import dataclasses
+import logging
+import multiprocessing
+import queue
+import threading
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Set
+
+from src.modelconfig import ModelConfig
+from src.server import log
+from src.server.log import LogConfig
+from src.server.metrics import ServerMetrics
+from src.server.monitor_client import MonitorStats
+from src.server.processor import Processor
+from src.server.work_distributor import RequestQueue, WorkDistributor
+
+logger = logging.getLogger(__name__)
+
+
+class Worker(ABC):
+    """Inference worker with its own Processor and ModelManager."""
+
+    def __init__(self, idx: int, processor_kwargs: Dict[str, Any]):
+        self.idx = idx
+        self.inbox: RequestQueue = None
+        self.processor_kwargs = dict(processor_kwargs)
+        self.guids = set()
+        self.loaded = set()
+
+    def preload(self, model_configs: List[ModelConfig]):
+        """Preload models once the worker starts."""
+        preload = self.processor_kwargs.setdefault("preload", [])
+        preload.extend(model_configs)
+        self.loaded.update(model_configs)
+
+    @abstractmethod
+    def start(
+        self,
+        results: WorkDistributor,
+        monitor_stats: MonitorStats,
+        metrics: ServerMetrics,
+    ):
+        """Start processing requests from inbox."""
+
+    def submit(self, guid: int, item):
+        self.inbox.put_request(guid, item)
+
+    def model_evicted(self, model_config: ModelConfig):
+        self.loaded.discard(model_config)
+
+    @property
+    def load(self) -> int:
+        return len(self.guids)
+
+
+class ThreadWorker(Worker):
+    def __init__(
+        self, idx: int, queue_size: int, processor_kwargs: Dict[str, Any]
+    ):
+        super().__init__(idx, processor_kwargs)
+        self.inbox = RequestQueue(queue.Queue(maxsize=queue_size))
+
+    def start(
+        self,
+        results: WorkDistributor,
+        monitor_stats: MonitorStats,
+        metrics: ServerMetrics,
+    ):
+        processor = Processor(
+            self.inbox,
+            results,
+            monitor_stats,
+            metrics=metrics,
+            on_evict=self.model_evicted,
+            monitor_viewed=monitor_stats.viewed_event(),
+            **self.processor_kwargs,
+        )
+        thread = threading.Thread(
+            target=processor.run, name=f"worker-{self.idx}", daemon=True
+        )
+        thread.start()
+
+
+class ProcessWorker(Worker):
+    """Runs Processor in a separate process.
+
+    Results, monitor updates, metrics, log records and model evictions
+    are forwarded back to the parent process through an outbox queue,
+    and applied there by a forwarding thread.
+    """
+
+    def __init__(
+        self, idx: int, queue_size: int, processor_kwargs: Dict[str, Any]
+    ):
+        super().__init__(idx, processor_kwargs)
+        # TensorFlow does not survive a fork, so always spawn
+        self.ctx = multiprocessing.get_context("spawn")
+        self.inbox = RequestQueue(self.ctx.Queue(maxsize=queue_size))
+        self.outbox = self.ctx.Queue()
+
+    def start(
+        self,
+        results: WorkDistributor,
+        monitor_stats: MonitorStats,
+        metrics: ServerMetrics,
+    ):
+        targets = {
+            "results": results,
+            "monitor_stats": monitor_stats,
+            "metrics": metrics,
+            "log_queue": log.log_queue(),
+            "worker": self,
+        }
+        process = self.ctx.Process(
+            target=_process_worker_main,
+            args=(
+                self.inbox,
+                self.outbox,
+                monitor_stats.viewed_event(self.ctx.Event()),
+                self.processor_kwargs,
+                log.log_config(),
+            ),
+            name=f"worker-{self.idx}",
+            daemon=True,
+        )
+        process.start()
+        thread = threading.Thread(
+            target=_forward,
+            args=(self.outbox, targets),
+            name=f"worker-{self.idx}-forward",
+            daemon=True,
+        )
+        thread.start()
+
+    def submit(self, guid: int, item):
+        request_type, payload = item
+        if request_type == "predict":
+            # Pooled buffers cannot cross process boundaries
+            frame_request = dataclasses.replace(
+                payload, data=bytes(payload.data), release=None
+            )
+            item = (request_type, frame_request)
+            if payload.release is not None:
+                payload.release()
+        self.inbox.put_request(guid, item)
+
+
+class _RemoteProxy:
+    """Forwards method calls to a target object in the parent process."""
+
+    def __init__(self, outbox: multiprocessing.Queue, target: str):
+        self._outbox = outbox
+        self._target = target
+
+    def __getattr__(self, name: str):
+        def method(*args, **kwargs):
+            self._outbox.put((self._target, name, args, kwargs))
+
+        return method
+
+
+def _process_worker_main(
+    inbox: RequestQueue,
+    outbox: multiprocessing.Queue,
+    monitor_viewed: multiprocessing.Event,
+    processor_kwargs: Dict[str, Any],
+    log_config: LogConfig,
+):
+    log.setup_worker_logging(log_config, _RemoteProxy(outbox, "log_queue"))
+    results = _RemoteProxy(outbox, "results")
+    monitor_stats = _RemoteProxy(outbox, "monitor_stats")
+    metrics = _RemoteProxy(outbox, "metrics")
+    worker = _RemoteProxy(outbox, "worker")
+    Processor(
+        inbox,
+        results,
+        monitor_stats,
+        metrics=metrics,
+        on_evict=worker.model_evicted,
+        monitor_viewed=monitor_viewed,
+        **processor_kwargs,
+    ).run()
+
+
+def _forward(outbox: multiprocessing.Queue, targets: Dict[str, Any]):
+    while True:
+        try:
+            target, name, args, kwargs = outbox.get()
+            getattr(targets[target], name)(*args, **kwargs)
+        except Exception:
+            logger.exception("Failed to forward call from worker")
+
+
+class WorkerPool:
+    """Distributes work items across a pool of inference workers.
+
+    Each worker has its own dispatcher, which only takes requests of
+    clients routed to that worker. Each worker inbox holds at most
+    queue_size requests; once full, its dispatcher blocks, so
+    backpressure propagates to the request queues of that worker's
+    clients, without holding up other workers.
+
+    Requests are routed per client, so all of a client's frames are
+    processed in order by a single worker. With model affinity enabled,
+    a client that acquires a model is (re)assigned to a worker that
+    already holds that model, or otherwise to the worker holding the
+    fewest models, so that each model is only loaded by as few workers
+    as possible. Clients spill over to another worker (which then loads
+    the model too) once every holder serves more than max_load clients,
+    or more than load_cost clients beyond the least loaded worker, so
+    that popular models do not leave other workers idle. A client
+    changing workers is held until its previous
+    worker has finished all of its earlier requests.
+    """
+
+    def __init__(
+        self,
+        work_distributor: WorkDistributor,
+        monitor_stats: MonitorStats,
+        metrics: ServerMetrics,
+        num_workers: int = 1,
+        kind: str = "thread",
+        affinity: bool = True,
+        max_load: int = None,
+        load_cost: int = 1,
+        queue_size: int = 0,
+        **processor_kwargs,
+    ):
+        worker_cls = {"thread": ThreadWorker, "process": ProcessWorker}[kind]
+        self.work_distributor = work_distributor
+        self.monitor_stats = monitor_stats
+        self.metrics = metrics
+        self.affinity = affinity
+        self.max_load = max_load
+        self.load_cost = load_cost
+        self.workers: List[Worker] = [
+            worker_cls(i, queue_size, processor_kwargs)
+            for i in range(num_workers)
+        ]
+        self.routes: Dict[int, Worker] = {}
+        # Clients whose held "acquire" was already routed to a new worker
+        self._moved: Set[int] = set()
+        self._lock = threading.Lock()
+
+    def preload(self, model_configs: Dict[str, List[ModelConfig]]):
+        """Preload models once workers start.
+
+        All configs of a model are preloaded by the same worker, so that
+        they share a single backbone. Models are spread evenly across
+        workers.
+        """
+        for _, configs in sorted(model_configs.items()):
+            worker = min(self.workers, key=lambda x: len(x.loaded))
+            worker.preload(configs)
+
+    def start(self):
+        for worker in self.workers:
+            worker.start(
+                self.work_distributor, self.monitor_stats, self.metrics
+            )
+            thread = threading.Thread(
+                target=self._dispatch,
+                args=(worker,),
+                name=f"dispatcher-{worker.idx}",
+                daemon=True,
+            )
+            thread.start()
+
+    def _dispatch(self, worker: Worker):
+        def eligible(guid: int) -> bool:
+            return self._worker_of(guid) is worker
+
+        while True:
+            try:
+                guid, item = self.work_distributor.get(eligible=eligible)
+                self._route(worker, guid, item)
+            except Exception:
+                logger.exception("Failed to dispatch request")
+
+    def _route(self, worker: Worker, guid: int, item):
+        request_type, payload = item
+
+        with self._lock:
+            self._move(guid, worker)
+            target = worker
+            if request_type == "acquire" and guid not in self._moved:
+                target = self._assign(guid, payload)
+            self._moved.discard(guid)
+            # Counts as holding the model already, even while client moves
+            if request_type == "acquire":
+                target.loaded.add(payload)
+            if request_type == "terminate":
+                del self.routes[guid]
+                worker.guids.discard(guid)
+
+        if target is worker:
+            worker.submit(guid, item)
+            return
+
+        # Hold the client until its current worker is done with it, then
+        # let the new worker's dispatcher pick up the "acquire" again
+        self.work_distributor.hold(guid, item)
+        with self._lock:
+            self._move(guid, target)
+            self._moved.add(guid)
+        worker.submit(guid, ("fence", None))
+
+    def _assign(self, guid: int, model_config: ModelConfig) -> Worker:
+        if not self.affinity:
+            return self._worker_of(guid)
+
+        def load(worker: Worker) -> int:
+            # Clients of worker, besides the one being assigned
+            return len(worker.guids - {guid})
+
+        holders = [x for x in self.workers if model_config in x.loaded]
+        if len(holders) == 0:
+            return min(self.workers, key=lambda x: (len(x.loaded), load(x)))
+        holder = min(holders, key=load)
+        idlest = min(self.workers, key=lambda x: (load(x), len(x.loaded)))
+        if (
+            self.max_load is not None and load(holder) > self.max_load
+        ) or load(holder) > load(idlest) + self.load_cost:
+            return idlest
+        return holder
+
+    def _worker_of(self, guid: int) -> Worker:
+        worker = self.routes.get(guid)
+        if worker is None:
+            worker = self.workers[guid % len(self.workers)]
+        return worker
+
+    def _move(self, guid: int, worker: Worker):
+        prev = self.routes.get(guid)
+        if prev is not None:
+            prev.guids.discard(guid)
+        self.routes[guid] = worker
+        worker.guids.add(guid)
@@ -1,11 +1,12 @@
-from typing import Tuple
+from typing import Optional, Tuple
 
 import tensorflow as tf
 from tensorflow import keras
+from tensorflow.keras.layers import Layer
 
 from src.lib.layers import decoders, encoders
 from src.lib.predecode import *
-from src.lib.split import split_model
+from src.lib.split import split_model, split_server_model
 from src.lib.tile import determine_tile_layout
 from src.modelconfig import ModelConfig, PostencoderConfig
 
@@ -48,6 +49,9 @@ def get_predecoder(
         if postencoder_type == "jpeg":
             tiled_layout = determine_tile_layout(tensor_layout)
             return JpegPredecoder(tiled_layout, tensor_layout)
+        if postencoder_type == "jpeg_gray":
+            tiled_layout = determine_tile_layout(tensor_layout)
+            return JpegGrayPredecoder(tiled_layout, tensor_layout)
         raise ValueError("Unknown postencoder")
 
     raise ValueError("Unknown encoder")
@@ -66,7 +70,21 @@ def split_model_by_config(
         model_server
         model_analysis
     """
-    layer = model_config.layer
+    encoder, decoder = _encoder_decoder_by_config(model_config)
+    return split_model(model, model_config.layer, encoder, decoder)
+
+
+def split_server_model_by_config(
+    model: keras.Model, model_config: ModelConfig,
+) -> keras.Model:
+    """Build server-side model sharing weights with given model."""
+    encoder, decoder = _encoder_decoder_by_config(model_config)
+    return split_server_model(model, model_config.layer, encoder, decoder)
+
+
+def _encoder_decoder_by_config(
+    model_config: ModelConfig,
+) -> Tuple[Optional[Layer], Optional[Layer]]:
     encoder = (
         None
         if model_config.encoder == "None"
@@ -77,4 +95,4 @@ def split_model_by_config(
         if model_config.decoder == "None"
         else decoders[model_config.decoder](**model_config.decoder_args)
     )
-    return split_model(model, layer, encoder, decoder)
+    return encoder, decoder
@@ -0,0 +1,75 @@
+import asyncio
+import json
+
+import numpy as np
+import pytest
+
+from src.server.comm import (
+    binary_confirmation,
+    binary_dropped,
+    binary_result,
+    json_dropped,
+    json_result,
+    read_message,
+)
+
+
+def _read_all(data: bytes):
+    async def read():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        messages = []
+        while True:
+            msg = await read_message(reader)
+            if msg is None:
+                return messages
+            messages.append(msg)
+
+    return asyncio.run(read())
+
+
+def test_json_messages():
+    result = json_result(3, 12, [("n01", "tench", 0.5)])
+    data = f"{result}\n{json_dropped(4, 100)}\n".encode()
+    assert _read_all(data) == [
+        json.loads(result),
+        {"type": "dropped", "frameNumber": 4, "numBytes": 100},
+    ]
+
+
+def test_binary_confirmation_and_dropped():
+    data = binary_confirmation(7, 1000) + binary_dropped(8, 2000)
+    assert _read_all(data) == [
+        {"type": "confirmation", "frameNumber": 7, "numBytes": 1000},
+        {"type": "dropped", "frameNumber": 8, "numBytes": 2000},
+    ]
+
+
+def test_binary_result():
+    indices = np.array([281, 0, 999])
+    scores = np.array([0.75, 0.125, 0.0625], dtype=np.float32)
+    data = binary_result(2 ** 32 - 1, 15, indices, scores)
+    assert _read_all(data) == [
+        {
+            "type": "result",
+            "frameNumber": 2 ** 32 - 1,
+            "inferenceTime": 15,
+            "indices": [281, 0, 999],
+            "scores": [0.75, 0.125, 0.0625],
+        }
+    ]
+
+
+def test_mixed_binary_and_json():
+    ready = '{"type": "ready"}\n'.encode()
+    empty = binary_result(1, 2, np.array([], dtype=int), np.array([]))
+    data = ready + empty + binary_dropped(2, 3) + ready
+    types = [x["type"] for x in _read_all(data)]
+    assert types == ["ready", "result", "dropped", "ready"]
+    assert _read_all(empty)[0]["indices"] == []
+
+
+def test_truncated_binary_message():
+    with pytest.raises(asyncio.IncompleteReadError):
+        _read_all(binary_dropped(1, 2)[:-1])
@@ -0,0 +1,126 @@
+import pytest
+
+pytest.importorskip("tensorflow")
+
+from src.modelconfig import ModelConfig
+from src.server import model_manager
+from src.server.model_manager import ModelManager
+
+MODEL_CONFIG = ModelConfig("resnet18", "add_5")
+OTHER_MODEL_CONFIG = ModelConfig("resnet18", "add_3")
+UNSHARED_MODEL_CONFIG = ModelConfig("resnet34", "add_5")
+NUM_BYTES = 100
+
+
+class _Model:
+    """Stands in for a keras.Model, recording what it was built from."""
+
+    def __init__(self, source):
+        self.source = source
+
+
+@pytest.fixture(autouse=True)
+def fake_models(tmp_path, monkeypatch):
+    """Load fake models, with a full model file for resnet18 only."""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "models" / "resnet18").mkdir(parents=True)
+    (tmp_path / "models" / "resnet18" / "resnet18-full.h5").touch()
+    monkeypatch.setattr(model_manager, "_load_backbone", _Model)
+    monkeypatch.setattr(model_manager, "_load_model", _Model)
+    monkeypatch.setattr(
+        model_manager, "split_server_model_by_config", lambda x, y: _Model(y)
+    )
+    monkeypatch.setattr(model_manager, "_warm_up", lambda x: None)
+    monkeypatch.setattr(
+        model_manager, "_model_num_bytes", lambda x: NUM_BYTES
+    )
+
+
+def _manager(**kwargs) -> ModelManager:
+    evicted = []
+    manager = ModelManager(
+        prediction_decoders={"resnet18": None, "resnet34": None},
+        on_evict=evicted.append,
+        **kwargs,
+    )
+    manager.evicted = evicted
+    return manager
+
+
+def test_split_models_share_backbone():
+    manager = _manager()
+    manager.acquire(MODEL_CONFIG)
+    manager.acquire(OTHER_MODEL_CONFIG)
+    assert manager.backbones["resnet18"].ref_count == 2
+    assert manager.memory_usage() == {
+        MODEL_CONFIG: 0,
+        OTHER_MODEL_CONFIG: 0,
+        "resnet18": NUM_BYTES,
+    }
+
+
+def test_failed_warm_up_releases_backbone(monkeypatch):
+    def warm_up(model):
+        raise RuntimeError("warm-up failed")
+
+    monkeypatch.setattr(model_manager, "_warm_up", warm_up)
+    manager = _manager()
+    with pytest.raises(RuntimeError):
+        manager.acquire(MODEL_CONFIG)
+    assert manager.backbones == {}
+    assert manager.models == {}
+
+
+def test_failed_split_releases_backbone(monkeypatch):
+    def split(backbone, model_config):
+        raise ValueError("unknown layer")
+
+    manager = _manager()
+    manager.acquire(OTHER_MODEL_CONFIG)
+    monkeypatch.setattr(model_manager, "split_server_model_by_config", split)
+    with pytest.raises(ValueError):
+        manager.acquire(MODEL_CONFIG)
+    assert manager.backbones["resnet18"].ref_count == 1
+
+
+def test_split_model_kept_while_backbone_in_use():
+    manager = _manager(memory_budget=0)
+    manager.acquire(MODEL_CONFIG)
+    manager.acquire(OTHER_MODEL_CONFIG)
+    manager.release(MODEL_CONFIG)
+    assert MODEL_CONFIG in manager.models
+    assert manager.evicted == []
+
+
+def test_split_models_evicted_with_backbone():
+    manager = _manager(memory_budget=0)
+    manager.acquire(MODEL_CONFIG)
+    manager.acquire(OTHER_MODEL_CONFIG)
+    manager.release(MODEL_CONFIG)
+    manager.release(OTHER_MODEL_CONFIG)
+    assert manager.evicted == [MODEL_CONFIG, OTHER_MODEL_CONFIG]
+    assert manager.models == {}
+    assert manager.backbones == {}
+
+
+def test_least_recently_released_evicted_first():
+    manager = _manager(memory_budget=2 * NUM_BYTES)
+    manager.preload(UNSHARED_MODEL_CONFIG)
+    manager.preload(MODEL_CONFIG)
+    manager.acquire(UNSHARED_MODEL_CONFIG)
+    manager.release(UNSHARED_MODEL_CONFIG)
+    assert manager.evicted == []
+    manager.acquire(ModelConfig("resnet50", "add_5"))
+    assert manager.evicted == [MODEL_CONFIG]
+    assert "resnet18" not in manager.backbones
+
+
+def test_reacquired_model_not_evicted():
+    manager = _manager(memory_budget=NUM_BYTES)
+    manager.preload(UNSHARED_MODEL_CONFIG)
+    manager.acquire(UNSHARED_MODEL_CONFIG)
+    manager.acquire(MODEL_CONFIG)
+    assert manager.evicted == []
+    manager.release(MODEL_CONFIG)
+    assert manager.evicted == [MODEL_CONFIG]
+    assert manager.models[UNSHARED_MODEL_CONFIG].ref_count == 1
@@ -0,0 +1,19 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("tensorflow")
+
+from src.lib.predecode import TensorPredecoder
+
+
+def test_tensor_shape_inferred_from_buffer():
+    predecoder = TensorPredecoder((-1,), np.float32)
+    assert predecoder.shape(bytes(40)) == (10,)
+    assert predecoder.shape(bytes(8)) == (2,)
+
+
+def test_tensor_shape_fixed():
+    predecoder = TensorPredecoder((2, 3), np.uint8)
+    buf = bytes(range(6))
+    assert predecoder.shape(buf) == predecoder.run(buf).shape
+
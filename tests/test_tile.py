@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("tensorflow")
+
+from src.lib.layouts import TensorLayout
+from src.lib.tile import determine_tile_layout, detile, tile, tile_plan
+
+
+def _tensor(shape, order):
+    arr = np.arange(np.prod(shape), dtype=np.uint8).reshape(shape)
+    return arr, TensorLayout.from_tensor(arr, order)
+
+
+@pytest.mark.parametrize("order", ["hwc", "chw"])
+@pytest.mark.parametrize("c", [4, 5, 6])
+def test_round_trip(order, c):
+    shape = {"hwc": (3, 2, c), "chw": (c, 3, 2)}[order]
+    arr, tensor_layout = _tensor(shape, order)
+    tiled_layout = determine_tile_layout(tensor_layout)
+    tiled = tile(arr, tensor_layout, tiled_layout)
+    assert tiled.shape == tiled_layout.shape
+    np.testing.assert_array_equal(
+        detile(tiled, tiled_layout, tensor_layout), arr
+    )
+
+
+def test_tiles_laid_out_row_major():
+    arr, tensor_layout = _tensor((3, 2, 2), "chw")
+    tiled_layout = determine_tile_layout(tensor_layout)
+    tiled = tile(arr, tensor_layout, tiled_layout)
+    np.testing.assert_array_equal(tiled[:2, :2], arr[0])
+    np.testing.assert_array_equal(tiled[:2, 2:], arr[1])
+    np.testing.assert_array_equal(tiled[2:, :2], arr[2])
+    # Area not covered by tiles
+    np.testing.assert_array_equal(tiled[2:, 2:], 0)
+
+
+def test_round_trip_through_padded_buffers():
+    arr, tensor_layout = _tensor((5, 3, 7), "hwc")
+    plan = tile_plan(tensor_layout, determine_tile_layout(tensor_layout))
+    tiled = plan.new_tiled(np.uint8, pad_to=16, channels=3)
+    assert tiled.shape == (16, 16, 3)
+    plan.tile(arr, out=tiled)
+    for i in range(3):
+        np.testing.assert_array_equal(tiled[..., i], tiled[..., 0])
+    out = np.empty_like(arr)
+    assert plan.detile(tiled[..., 0], out=out) is out
+    np.testing.assert_array_equal(out, arr)
+
+
+def test_plans_cached():
+    _, tensor_layout = _tensor((3, 2, 4), "hwc")
+    tiled_layout = determine_tile_layout(tensor_layout)
+    assert tile_plan(tensor_layout, tiled_layout) is tile_plan(
+        tensor_layout, tiled_layout
+    )
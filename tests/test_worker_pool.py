@@ -0,0 +1,94 @@
+import pytest
+
+pytest.importorskip("tensorflow")
+
+from src.modelconfig import ModelConfig
+from src.server.worker_pool import WorkerPool
+
+MODEL_CONFIG = ModelConfig("resnet18", "add_5")
+OTHER_MODEL_CONFIG = ModelConfig("resnet18", "add_3")
+
+
+class _Distributor:
+    """Stands in for WorkDistributor, recording held clients."""
+
+    def __init__(self):
+        self.held = []
+
+    def hold(self, guid, item):
+        self.held.append((guid, item))
+
+
+def _pool(**kwargs) -> WorkerPool:
+    return WorkerPool(_Distributor(), None, None, **kwargs)
+
+
+def _acquire(pool: WorkerPool, guid: int, model_config: ModelConfig):
+    """Route "acquire" as dispatchers would, following any move."""
+    item = ("acquire", model_config)
+    pool._route(pool._worker_of(guid), guid, item)
+    if len(pool.work_distributor.held) != 0:
+        pool.work_distributor.held.clear()
+        pool._route(pool._worker_of(guid), guid, item)
+    return pool._worker_of(guid)
+
+
+def test_clients_of_model_share_worker():
+    pool = _pool(num_workers=4)
+    workers = {_acquire(pool, guid, MODEL_CONFIG) for guid in range(2)}
+    assert len(workers) == 1
+    assert [len(x.loaded) for x in pool.workers].count(1) == 1
+
+
+def test_staggered_clients_spread_across_workers():
+    pool = _pool(num_workers=4)
+    for guid in range(8):
+        _acquire(pool, guid, MODEL_CONFIG)
+    assert [x.load for x in pool.workers] == [2, 2, 2, 2]
+
+
+def test_max_load_spills_over():
+    pool = _pool(num_workers=2, max_load=1, load_cost=100)
+    for guid in range(3):
+        _acquire(pool, guid, MODEL_CONFIG)
+    assert sorted(x.load for x in pool.workers) == [1, 2]
+
+
+def test_without_affinity_clients_stay_on_default_worker():
+    pool = _pool(num_workers=2, affinity=False)
+    for guid in range(4):
+        assert _acquire(pool, guid, MODEL_CONFIG) is pool.workers[guid % 2]
+
+
+def test_new_model_goes_to_worker_holding_fewest():
+    pool = _pool(num_workers=2)
+    first = _acquire(pool, 0, MODEL_CONFIG)
+    second = _acquire(pool, 1, OTHER_MODEL_CONFIG)
+    assert first is not second
+
+
+def test_moved_client_fences_previous_worker():
+    pool = _pool(num_workers=2)
+    _acquire(pool, 0, MODEL_CONFIG)
+    worker = pool._worker_of(1)
+    pool._route(worker, 1, ("acquire", MODEL_CONFIG))
+    assert pool.work_distributor.held == [(1, ("acquire", MODEL_CONFIG))]
+    assert worker.inbox.get(timeout=0) == (1, ("fence", None))
+    assert pool._worker_of(1) is pool._worker_of(0)
+
+
+def test_evicted_model_is_forgotten():
+    pool = _pool(num_workers=2)
+    worker = _acquire(pool, 0, MODEL_CONFIG)
+    worker.model_evicted(MODEL_CONFIG)
+    assert MODEL_CONFIG not in worker.loaded
+
+
+def test_moving_client_counts_toward_holder():
+    pool = _pool(num_workers=4)
+    for guid in range(2):
+        _acquire(pool, guid, MODEL_CONFIG)
+    # Client 2 spills over, but has yet to reach its new worker
+    pool._route(pool._worker_of(2), 2, ("acquire", MODEL_CONFIG))
+    pool.work_distributor.held.clear()
+    assert _acquire(pool, 3, MODEL_CONFIG) is pool._worker_of(2)